@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+#
+#  AsyncCloud - asyncio version of low level yandex.disk REST API wrapper
+#
+#  Copyright 2016,2017 Sly_tom_cat <slytomcat@mail.ru>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import aiohttp
+from json import dumps, loads
+from time import time
+from threading import Thread
+from os import stat as file_info, truncate
+from os.path import exists as pathExists
+from Cloud import Cloud, _Retry, _Bucket, _Metrics, _Digest
+from logging import warning
+
+class _Reply(object):
+  ''' completely received response: status, headers and text of body'''
+  __slots__ = ('status', 'headers', 'text')
+
+  def __init__(self, status, headers, text=''):
+    self.status = status
+    self.headers = headers
+    self.text = text
+
+def _size(path):
+  ''' returns size of file or 0 when it doesn't exist'''
+  return file_info(path).st_size if pathExists(path) else 0
+
+def _check(path, digest, sha):
+  ''' returns None when sha256 of downloaded file is sha, otherwise the file is truncated (the
+      received data are wrong: don't resume from them) and the sha256 of received data returned
+  '''
+  digest.seek(file_info(path).st_size)  # hash the data that were not passed through
+  if digest.hexdigest() == sha:
+    return None
+  truncate(path, 0)
+  return digest.hexdigest()
+
+class AsyncCloud(object):
+  '''
+    The asyncio version of Cloud. The task coroutine has the same commands, arguments and
+    results as Cloud.task, so one event loop can keep thousands of requests in flight without
+    a thread per request. The exceptions are the streaming commands 'items', 'files' and 'tree':
+    they return error NotSupportedError ('list' by pages can be used instead), and 'down' accepts
+    size argument but always downloads the file by single stream. All requests are performed
+    via one aiohttp session with connection pool. Asynchronous operations (202) are polled by
+    the coroutine itself, the retry policy and rate limits are the same as in Cloud. File
+    operations are performed in the default executor of the loop, so they don't block it.
+
+    Optional config is the same dictionary as for Cloud. Following keys are used here:
+      'baseurl', 'retry_*', 'rate_meta', 'rate_href', 'poll_*', 'list_records',
+      'metrics_interval', 'timeout_connect', 'timeout_read', 'timeout_stall' - see Cloud,
+      'connections'  - maximal number of simultaneous connections (default: 100)
+      'down_chunk'   - size of download chunk (default: 1 MB)
+  '''
+  def __init__(self, token, config=None):
+    self.config = config or {}
+    self.baseurl = self.config.get('baseurl', Cloud.BASEURL)
+    self._headers = {'Accept': 'application/json', 'Authorization': token}
+    self._connections = self.config.get('connections', 100)
+    self._client = None   # aiohttp session is created in the event loop on first request
+    self._retry = _Retry(self.config.get('retry_time', 60), self.config.get('retry_delay', 0.5),
+                         self.config.get('retry_delay_max', 15),
+                         self.config.get('retry_budget', 0.2), self.config.get('retry_reserve', 20))
+    self._rate = _Bucket(self.config.get('rate_meta', 0))
+    self._rate_href = _Bucket(self.config.get('rate_href', 0))
+    self._pmin = self.config.get('poll_min', 0.5)
+    self._pmax = self.config.get('poll_max', 10)
+    self._ptimeout = self.config.get('poll_timeout', 3600)
+    self._chunk = self.config.get('down_chunk', 1 << 20)
+    self._records = self.config.get('list_records', False)
+    self._metrics = _Metrics(self.config.get('metrics_interval', 600))
+    connect = self.config.get('timeout_connect', 10)
+    self._timeout = aiohttp.ClientTimeout(sock_connect=connect,
+                                          sock_read=self.config.get('timeout_read', 30))
+    self._stall = aiohttp.ClientTimeout(sock_connect=connect,
+                                        sock_read=self.config.get('timeout_stall', 60))
+    self._polls = 0     # number of status requests of asynchronous operations
+    self._pending = 0   # number of unfinished asynchronous operations
+    self._flight = dict()  # 'res' requests in flight {path: asyncio.Future}
+
+  def pending(self):
+    ''' returns number of unfinished asynchronous operations'''
+    return self._pending
+
+  def metrics(self):
+    ''' returns statistics of requests (see Cloud.metrics)'''
+    res = self._metrics.snapshot()
+    res['poll'] = {'outstanding': self._pending, 'polls': self._polls}
+    res['retries'] = self._retry.retries
+    return res
+
+  def _session(self):
+    if self._client is None:
+      self._client = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=self._connections, limit_per_host=self._connections),
+        timeout=self._timeout)
+    return self._client
+
+  async def close(self):
+    if self._client is not None:
+      await self._client.close()
+      self._client = None
+
+  async def _call(self, cmd, func):
+    ''' await func() that returns _Reply until it returns non-transient result (see _Retry)'''
+    start = self._retry.start()
+    name = Cloud.METRIC.get(cmd, cmd)
+    attempt = 0
+    while True:
+      exc = r = None
+      try:
+        r = await func()
+        delay = self._retry.delay(cmd, attempt, start, r.status, r.headers)
+      except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        exc = e
+        delay = self._retry.delay(cmd, attempt, start,
+                                  sent=not isinstance(e, aiohttp.ClientConnectorError))
+      if delay is None:
+        self._metrics.record(name, time() - start, exc.__class__.__name__ if exc else r.status)
+        if exc is not None:
+          raise exc
+        return r
+      warning('%s: retry #%d in %.1f sec after %s' % (cmd, attempt + 1, delay, exc or r.status))
+      await asyncio.sleep(delay)
+      attempt += 1
+
+  async def _request(self, cmd, *args, **kwargs):
+    ''' format URL, perform request and handle asynchronous operations'''
+    method, url, code = Cloud.CMD[cmd]
+    url = self.baseurl + url.format(*args)
+    bucket = self._rate_href if cmd in ('up', 'down') else self._rate
+    session = self._session()
+
+    async def req():
+      await asyncio.sleep(bucket.reserve())  # wait for the rate limit
+      async with session.request(method, url, headers=self._headers, **kwargs) as r:
+        body = await r.read()
+        self._metrics.add(Cloud.METRIC.get(cmd, cmd), len(body))
+        return _Reply(r.status, r.headers, body.decode())
+
+    try:
+      r = await self._call(cmd, req)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      return False, Cloud._exception(e)
+    status_code = r.status
+    result = loads(r.text) if r.text else ''
+    if status_code == 202:  # it is asynchronous operation
+      return await self._poll(result['href'], code)
+    ok = status_code == code
+    if not ok:
+      result['code'] = status_code  # add status code into error description
+    return ok, result
+
+  async def _poll(self, href, code):
+    ''' wait for the finish of asynchronous operation with exponentially growing interval'''
+    self._pending += 1
+    try:
+      start = time()
+      interval = self._pmin
+      while True:
+        await asyncio.sleep(interval)
+        interval = min(interval * 2, self._pmax)
+        self._polls += 1
+        try:
+          await asyncio.sleep(self._rate.reserve())
+          async with self._session().get(href, headers=self._headers) as r:
+            st = r.status
+            res = loads(await r.text() or '{}')
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+          st, res = 200, dict()   # it can be a temporary failure: check it again later
+        if st != 200:
+          res['code'] = st
+          return False, res
+        if res.get("status") == "success":
+          return True, res
+        if res.get("status") == "failed":
+          return False, {'error': 'FailedAsyncOperationError', 'code': 404}
+        if time() - start > self._ptimeout:
+          return False, {'error': 'AsyncOperationTimeout', 'code': -1}
+    finally:
+      self._pending -= 1
+
+  @staticmethod
+  async def _file(func, *args):
+    ''' perform blocking file operation in the default executor of the event loop'''
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+  async def _upload(self, href, lpath):
+    async def put():
+      # file is opened again by each attempt (aiohttp reads it in the executor)
+      with await self._file(open, lpath, 'rb') as f:
+        async with self._session().put(href, data=f, timeout=self._stall) as r:
+          self._metrics.add('up-transfer', f.tell())
+          return _Reply(r.status, r.headers, await r.text())
+
+    r = await self._call('up-transfer', put)
+    if r.status in (201, 200):
+      return True, None
+    result = loads(r.text) if r.text else dict()
+    result['code'] = r.status
+    return False, result
+
+  async def _download(self, href, lpath, resume=False, digest=None):
+    ''' see Cloud._fetch: resume and digest have the same meaning'''
+    async def get():
+      nonlocal resume
+      # request the rest of file when some part of it is already received
+      offset = await self._file(_size, lpath) if resume else 0
+      resume = True   # each retry continues from the last received byte
+      headers = {'Range': 'bytes=%d-' % offset} if offset else None
+      async with self._session().get(href, timeout=self._stall, headers=headers) as r:
+        if r.status == 416 and Cloud._range(r)[2] == offset:
+          return _Reply(206, r.headers)   # file was completely received before
+        if r.status not in (200, 206):
+          return _Reply(r.status, r.headers, await r.text())
+        start = Cloud._range(r)[0] if r.status == 206 else 0
+        f = await self._file(open, lpath, 'r+b' if start else 'wb')
+        try:
+          def prepare():
+            f.seek(start)
+            f.truncate()
+            if digest is not None:
+              digest.seek(start)   # it reads the received part of file
+
+          def write(data):
+            f.write(data)
+            if digest is not None:
+              digest.update(data)
+
+          await self._file(prepare)
+          async for chunk in r.content.iter_chunked(self._chunk):
+            await self._file(write, chunk)
+            self._metrics.add('down-transfer', len(chunk))
+        finally:
+          await self._file(f.close)
+        return _Reply(r.status, r.headers)
+
+    r = await self._call('down-transfer', get)
+    if r.status in (200, 206):
+      return True, None
+    result = loads(r.text) if r.text else dict()
+    result['code'] = r.status
+    return False, result
+
+  async def task(self, cmd, *args, **kwargs):
+    ''' Universal disk operation coroutine. See Cloud.task for commands and results.'''
+    if cmd == 'res_many':
+      paths = list(args[0])
+      return True, dict(zip(paths, await asyncio.gather(*(self.task('res', p) for p in paths))))
+    if cmd == 'res':
+      return await self._single(args[0])
+    if cmd in ('items', 'files', 'tree'):
+      return Cloud._done(cmd, args, False, {'code': -1, 'error': 'NotSupportedError',
+                                            'description': 'streaming command of Cloud only'})
+    return await self._task(cmd, *args, **kwargs)
+
+  async def _single(self, path):
+    ''' simultaneous 'res' requests for the same path are collapsed into one request'''
+    ft = self._flight.get(path)
+    if ft is None:
+      ft = self._flight[path] = asyncio.ensure_future(self._task('res', path))
+      ft.add_done_callback(lambda _: self._flight.pop(path, None))
+    status, result = await asyncio.shield(ft)
+    return status, dict(result) if isinstance(result, dict) else result
+
+  async def _task(self, cmd, *args, **kwargs):
+    # handle input parameters
+    if cmd in ('up', 'down'):
+      # remove local path from args for upload and download operations
+      lpath = args[1]
+      args = (args[0],)
+      resume = kwargs.pop('resume', False)
+      kwargs.pop('size', None)   # segmented download is not supported here
+      sha = kwargs.pop('sha256', None)
+    elif cmd == 'prop':
+      kwargs = {'data': dumps({"custom_properties": kwargs})}
+    elif cmd in ('move', 'copy'):
+      kwargs = {'params': {'overwrite': 'true'}} if kwargs.get('overwrite') else {}
+
+    # perform request
+    status, result = await self._request(cmd, *args, **kwargs)
+
+    # handle (pass) some errors
+    if not status and cmd == 'mkdir' and result['error'] == 'DiskPathPointsToExistentDirectoryError':
+      status = True
+
+    if status:
+      if cmd in {'prop', 'mkdir', 'del', 'trash', 'move', 'copy'}:
+        return Cloud._done(cmd, args, True, result)
+      elif cmd in ('up', 'down'):
+        try:
+          if cmd == 'up':
+            status, result = await self._upload(result['href'], lpath)
+          else:
+            digest = None if sha is None else _Digest(lpath)
+            status, result = await self._download(result['href'], lpath, resume, digest)
+            if status and digest is not None:
+              received = await self._file(_check, lpath, digest, sha)
+              if received is not None:
+                status, result = False, {'code': -1, 'error': 'ChecksumMismatchError',
+                                         'path': lpath, 'description':
+                                         'sha256 of received data is %s instead of %s' %
+                                         (received, sha)}
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:  # they can be OSError too
+          status, result = False, Cloud._exception(e)
+        except OSError as e:
+          # prepare error description for failed file operation
+          status, result = False, {'code': -1, 'error': 'OSError', 'path': lpath,
+                                   'errno': e.errno, 'description': e.strerror}
+      else:
+        return True, Cloud._format(cmd, result, self._records)
+    return Cloud._done(cmd, args, status, result)
+
+class SyncCloud(object):
+  '''
+    Thin synchronous adapter of AsyncCloud for existing callers: the event loop runs in the
+    background thread and task method waits for the result of AsyncCloud.task coroutine.
+    The submit method returns concurrent.futures.Future without waiting, so one thread can
+    put thousands of operations in flight.
+  '''
+  def __init__(self, token, config=None):
+    self.cloud = AsyncCloud(token, config)
+    self._loop = asyncio.new_event_loop()
+    self._thread = Thread(target=self._loop.run_forever)
+    self._thread.name = 'AsyncCloud'
+    self._thread.daemon = True
+    self._thread.start()
+
+  def submit(self, cmd, *args, **kwargs):
+    return asyncio.run_coroutine_threadsafe(self.cloud.task(cmd, *args, **kwargs), self._loop)
+
+  def task(self, cmd, *args, **kwargs):
+    return self.submit(cmd, *args, **kwargs).result()
+
+  def pending(self):
+    return self.cloud.pending()
+
+  def close(self):
+    asyncio.run_coroutine_threadsafe(self.cloud.close(), self._loop).result()
+    self._loop.call_soon_threadsafe(self._loop.stop)
+    self._thread.join()
+    self._loop.close()
@@ -18,100 +18,1449 @@
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import requests
-from time import sleep
-from json import dumps
-from logging import error
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError, DecodeError, NewConnectionError
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from socket import socket
+from errno import EIO
+from os import cpu_count, stat as file_info, pwrite, truncate
+from os.path import exists as pathExists
+from urllib.parse import quote
+from re import fullmatch, compile as re_compile
+from time import time, sleep, localtime
+from json import dumps, JSONDecoder
+from codecs import getincrementaldecoder
+from hashlib import sha256
+from random import uniform
+from email.utils import parsedate_to_datetime
+from threading import Thread, Condition, Lock, local
+from heapq import heappush, heappop
+from bisect import bisect_left
+from collections import namedtuple, OrderedDict, deque
+from copy import deepcopy
+from concurrent.futures import Future
+from PoolExecutor import ThreadPoolExecutor
+from CloudTrace import Recorder, Player, RecordAdapter, ReplayAdapter
+from logging import info, warning, error
+
+class _Canceled(Exception):
+  ''' raised to stop the work that is not required anymore (it is not retried)'''
+
+class _Item(namedtuple('_Item', 'path type modified sha256 size custom_properties')):
+  '''
+    Compact record of cloud file returned by 'list' request in records mode (see Cloud). It takes
+    much less memory than dict, but its fields are still available by keys like items of dict.
+  '''
+  __slots__ = ()
+
+  def __getitem__(self, key):
+    return getattr(self, key) if isinstance(key, str) else tuple.__getitem__(self, key)
+
+  def get(self, key, default=None):
+    return getattr(self, key, default)
+
+class _Items(object):
+  '''
+    Incremental parser of the items array of JSON object like {"items": [{...}, {...}], ...}.
+    Data are passed to feed method as they are received and it returns the list of items that
+    are received completely. Only the not parsed tail of data is kept in the buffer.
+  '''
+  START = re_compile(r'"items"\s*:\s*\[')
+  SKIP = re_compile(r'[\s,]*')
+
+  def __init__(self):
+    self._decoder = JSONDecoder()
+    self._text = getincrementaldecoder('utf-8')()
+    self._buf = ''
+    self._started = False
+    self.done = False   # the end of items array is received
+
+  def feed(self, data):
+    if self.done:
+      return []
+    buf = self._buf + self._text.decode(data)
+    pos = 0
+    if not self._started:
+      m = self.START.search(buf)
+      if m is None:
+        self._buf = buf
+        return []
+      self._started = True
+      pos = m.end()
+    items = []
+    while True:
+      pos = self.SKIP.match(buf, pos).end()
+      if pos == len(buf):
+        break
+      if buf[pos] == ']':
+        self.done = True
+        break
+      try:
+        item, pos = self._decoder.raw_decode(buf, pos)
+      except ValueError:
+        break   # the item is not received completely yet
+      items.append(item)
+    self._buf = buf[pos:]
+    return items
+
+class _Poller(object):
+  '''
+    Shared poller of asynchronous operations (requests that returned 202).
+    All pending operations are tracked by one thread, every operation is checked with
+    exponentially growing interval (from pmin up to pmax seconds). When the operation status
+    changes the future (returned by add method) is resolved with tuple (status, result) like
+    Cloud._request returns. Operation that is not finished within ptimeout seconds is reported
+    as failed with 'AsyncOperationTimeout' error.
+  '''
+  def __init__(self, session, rate, pmin, pmax, ptimeout, timeout=None):
+    self._session = session
+    self._timeout = timeout   # timeout of status request (see Cloud)
+    self._rate = rate
+    self._pmin = pmin
+    self._pmax = pmax
+    self._ptimeout = ptimeout
+    self._heap = []     # [next check time, seq, href, code, future, interval, start time]
+    self._seq = 0
+    self._cond = Condition()
+    self._thread = None
+    self.polls = 0      # total number of status requests
+    self.completed = 0  # number of successfully finished operations
+    self.failed = 0     # number of failed operations
+
+  def add(self, href, code):
+    ''' start tracking of operation <href> that returns <code> on success'''
+    ft = Future()
+    with self._cond:
+      self._seq += 1
+      now = time()
+      heappush(self._heap, [now + self._pmin, self._seq, href, code, ft, self._pmin, now])
+      if self._thread is None:
+        self._thread = Thread(target=self._run)
+        self._thread.name = 'AsyncPoller'
+        self._thread.daemon = True
+        self._thread.start()
+      self._cond.notify()
+    return ft
+
+  def outstanding(self):
+    return len(self._heap)
+
+  def stats(self):
+    return {'outstanding': self.outstanding(), 'polls': self.polls,
+            'completed': self.completed, 'failed': self.failed}
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while not self._heap:
+          self._cond.wait()
+        delay = self._heap[0][0] - time()
+        if delay > 0:
+          self._cond.wait(delay)  # new operation can be added while waiting
+          continue
+        op = self._heap[0]
+      # check operation out of lock to allow new operations to be added meanwhile
+      result = self._check(op)
+      with self._cond:
+        heappop(self._heap)
+        if result is None:  # still in progress: check it later with longer interval
+          op[5] = min(op[5] * 2, self._pmax)
+          op[0] = time() + op[5]
+          heappush(self._heap, op)
+      if result is not None:
+        op[4].set_result(result)
+
+  def _check(self, op):
+    ''' request the operation status. Returns None when operation is still in progress'''
+    _, _, href, code, _, _, start = op
+    self.polls += 1
+    try:
+      self._rate.acquire()
+      r = self._session.get(href, timeout=self._timeout)
+      st = r.status_code
+      res = r.json() if r.text else dict()
+    except (requests.RequestException, ValueError):
+      st, res = 200, dict()   # it can be a temporary failure: check it again later
+    if st == 200:
+      if res.get("status") == "success":
+        self.completed += 1
+        return True, res
+      if res.get("status") == "failed":
+        self.failed += 1
+        return False, {'error': 'FailedAsyncOperationError', 'code': 404}
+      if time() - start > self._ptimeout:
+        self.failed += 1
+        return False, {'error': 'AsyncOperationTimeout', 'code': -1}
+      return None
+    self.failed += 1
+    res['code'] = st
+    return False, res
+
+class _Metrics(object):
+  '''
+    Statistics of requests by command: number of requests and errors, latency histogram, HTTP
+    status codes and transferred bytes. Latency of request includes the time of its retries.
+    The summary is logged not more often than once per interval seconds (0 - never).
+  '''
+  BOUNDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # latency buckets (sec)
+
+  def __init__(self, interval):
+    self._interval = interval
+    self._logged = time()
+    self._lock = Lock()
+    self._data = dict()
+
+  def _get(self, name):
+    m = self._data.get(name)
+    if m is None:
+      m = self._data[name] = {'count': 0, 'errors': 0, 'time': 0.0, 'max': 0.0, 'bytes': 0,
+                              'hist': [0] * (len(self.BOUNDS) + 1), 'status': dict()}
+    return m
+
+  def record(self, name, sec, status):
+    ''' register finished request, status is HTTP status code or name of exception'''
+    with self._lock:
+      m = self._get(name)
+      m['count'] += 1
+      m['time'] += sec
+      m['max'] = max(m['max'], sec)
+      m['hist'][bisect_left(self.BOUNDS, sec)] += 1
+      m['status'][status] = m['status'].get(status, 0) + 1
+      if not isinstance(status, int) or status >= 400:
+        m['errors'] += 1
+    if self._interval and time() - self._logged >= self._interval:
+      self._logged = time()
+      info('metrics: %s' % self.summary())
+
+  def add(self, name, size):
+    ''' register size of transferred data'''
+    with self._lock:
+      self._get(name)['bytes'] += size
+
+  def snapshot(self):
+    ''' returns copy of statistics: {name: {count, errors, time, max, bytes, hist, status}}'''
+    with self._lock:
+      return {name: dict(m, hist=list(m['hist']), status=dict(m['status']))
+              for name, m in self._data.items()}
+
+  def quantile(self, hist, q):
+    ''' upper bound of the latency bucket that contains q quantile'''
+    n = q * sum(hist)
+    for bound, count in zip(self.BOUNDS + (float('inf'),), hist):
+      n -= count
+      if n <= 0:
+        return bound
+    return 0
+
+  def summary(self):
+    return '; '.join('%s: %d req %d err avg %.3f p95 <%g max %.3f sec %d bytes' %
+                     (name, m['count'], m['errors'], m['time'] / (m['count'] or 1),
+                      self.quantile(m['hist'], 0.95), m['max'], m['bytes'])
+                     for name, m in sorted(self.snapshot().items()))
+
+class _Cache(object):
+  '''
+    Cache of results of requests without arguments (like 'info' and 'last'). The result that is
+    younger than ttl seconds is returned without request. Older result is returned too, but its
+    refresh is started in background by executor. Invalidated results are requested again
+    synchronously. Failed results are not cached. Zero ttl means no caching. Each caller
+    receives its own copy of the cached result.
+  '''
+  def __init__(self, ttl, executor):
+    self._ttl = ttl
+    self._executor = executor
+    self._lock = Lock()
+    self._data = dict()      # {key: (time of request, result)}
+    self._refresh = set()    # keys that are refreshed now
+    self._gen = 0            # generation of data: it is changed by each invalidation
+
+  def get(self, key, func):
+    if not self._ttl:
+      return func()
+    with self._lock:
+      entry = self._data.get(key)
+      if entry is not None:
+        if time() - entry[0] > self._ttl and key not in self._refresh:
+          self._refresh.add(key)
+          self._executor.submit(self._update, key, func, self._gen, True)
+        return deepcopy(entry[1])
+      gen = self._gen
+    return self._update(key, func, gen)
+
+  def _update(self, key, func, gen, refresh=False):
+    ''' request the result, gen is the generation of data when the request was decided'''
+    stamp = time()
+    try:
+      res = func()
+    finally:
+      with self._lock:
+        if refresh:
+          self._refresh.discard(key)
+    with self._lock:
+      if res[0] and gen == self._gen:  # result is not stored when cache was invalidated meanwhile
+        self._data[key] = (stamp, deepcopy(res))
+    return res
+
+  def invalidate(self):
+    with self._lock:
+      self._gen += 1
+      self._data.clear()
+
+class _Retry(object):
+  '''
+    Retry policy for cloud requests.
+    Transient failures (connection errors, timeouts, 429 and 5xx responses) are retried with
+    jittered exponential backoff (or after the delay from Retry-After header) while total retry
+    time for one request is less than limit. Not idempotent operations are retried only when it
+    is known that the request was not processed: 429 response or connection timeout.
+    Retries are limited by the budget: each request adds ratio of retry to budget (up to cap)
+    and each retry takes one from it. So the storm of failures doesn't multiply the load.
+    Requests wait while the breaker is open. The request that fails by connection error when the
+    breaker is open (or becomes open by this error) is repeated after the breaker is closed,
+    instead of failing, when it can be repeated (see above). Stalled and too slow transfers fail
+    by timeouts, so they are not counted by the breaker as the network is reachable.
+  '''
+  # cmd : is it safe to repeat request that probably was processed
+  IDEMPOTENT = {'info': True, 'last': True, 'res': True, 'list': True, 'dir': True, 'prop': True,
+                'mkdir': True, 'del': False, 'trash': False, 'move': False, 'copy': False,
+                'up': True, 'down': True, 'up-transfer': True, 'down-transfer': True}
+  STATUS = {429, 500, 502, 503, 504}  # transient failure response codes
+
+  def __init__(self, limit, delay, delay_max, ratio, reserve, breaker=None):
+    self._limit = limit
+    self._delay = delay
+    self._delay_max = delay_max
+    self._ratio = ratio
+    self._cap = reserve
+    self._budget = reserve
+    self._breaker = breaker if breaker is not None else _Breaker()
+    self._lock = Lock()
+    self.retries = 0    # total number of retries
+
+  def call(self, cmd, func):
+    ''' call func() that returns response until it returns non-transient result'''
+    start = self.start()
+    attempt = 0
+    while True:
+      if self._breaker.wait():   # it was parked: time of retries is counted from now
+        start = time()
+        attempt = 0
+      exc = r = None
+      try:
+        r = func()
+        self._breaker.success()
+        delay = self.delay(cmd, attempt, start, r.status_code, r.headers)
+      except requests.RequestException as e:
+        exc = e
+        sent = self._sent(e)
+        if (isinstance(e, requests.ConnectionError) and self._breaker.failure() and
+            (self.IDEMPOTENT[cmd] or not sent)):
+          warning('%s: parked until the network is available after %s' % (cmd, e))
+          continue
+        delay = self.delay(cmd, attempt, start, sent=sent)
+      if delay is None:
+        if exc is not None:
+          raise exc
+        return r
+      warning('%s: retry #%d in %.1f sec after %s' %
+              (cmd, attempt + 1, delay, exc or r.status_code))
+      if r is not None:
+        r.close()   # release connection
+      sleep(delay)
+      attempt += 1
+
+  @staticmethod
+  def _sent(e):
+    ''' returns False when the failed request surely was not sent (no connection was made)'''
+    if isinstance(e, requests.ConnectTimeout):
+      return False
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return not isinstance(reason, NewConnectionError)
+
+  def start(self):
+    ''' register the new request in budget. Returns start time of request'''
+    with self._lock:
+      self._budget = min(self._budget + self._ratio, self._cap)
+    return time()
+
+  def delay(self, cmd, attempt, start, status=None, headers=None, sent=True):
+    ''' Returns the delay before next attempt or None when request should not be retried.
+        status is None for failed request (sent is False when request was surely not sent).
+    '''
+    if status is None:
+      retry = self.IDEMPOTENT[cmd] or not sent
+    else:
+      retry = status in self.STATUS and (status == 429 or self.IDEMPOTENT[cmd])
+    if retry:
+      delay = self._pause(attempt, headers)
+      if time() - start + delay <= self._limit and self._take():
+        return delay
+    return None
+
+  def _pause(self, attempt, headers):
+    ''' delay before next attempt'''
+    after = headers.get('Retry-After') if headers is not None else None
+    if after:
+      try:
+        return max(float(after), 0)
+      except ValueError:
+        try:
+          return max(parsedate_to_datetime(after).timestamp() - time(), 0)
+        except (TypeError, ValueError):
+          pass
+    return uniform(0, min(self._delay_max, self._delay * 2 ** attempt))
+
+  def _take(self):
+    with self._lock:
+      if self._budget < 1:
+        return False
+      self._budget -= 1
+      self.retries += 1
+      return True
+
+class _Breaker(object):
+  '''
+    Circuit breaker of network connection. After limit consecutive connection errors it is open
+    (the network is considered lost): requests are parked in wait until it is closed again, so
+    queued work doesn't fail one by one at timeout speed. While it is open, probe() is called by
+    separate thread with exponential backoff (from delay to delay_max seconds). Any response
+    (of request or probe) closes it and wakes parked requests. changed(online) is called when
+    the breaker is opened (online is False) and closed (online is True). release() makes parked
+    and new requests fail at once until the breaker is closed (e.g. before exit).
+  '''
+  def __init__(self, limit=0, delay=1, delay_max=60, probe=None, changed=None):
+    self._limit = limit     # 0 - breaker is off
+    self._delay = delay
+    self._delay_max = delay_max
+    self._probe = probe
+    self._changed = changed
+    self._errors = 0        # number of consecutive connection errors
+    self._cond = Condition()
+    self.open = False
+    self.released = False
+
+  def wait(self):
+    ''' park the calling thread while the breaker is open. Returns True when it was parked'''
+    with self._cond:
+      if not self.open:
+        return False
+      while self.open and not self.released:
+        self._cond.wait()
+      if self.open:
+        raise requests.ConnectionError('network is not available')
+    return True
+
+  def success(self):
+    with self._cond:
+      self._errors = 0
+      if not self.open:
+        return
+      self.open = False
+      self._cond.notify_all()
+    info('network is available')
+    self._changed(True)
+
+  def failure(self):
+    ''' register connection error. Returns True when the breaker is open'''
+    with self._cond:
+      self._errors += 1
+      if self.open or not self._limit or self._errors < self._limit:
+        return self.open
+      self.open = True
+      self.released = False
+    warning('network is not available after %d connection errors' % self._errors)
+    thread = Thread(target=self._run)
+    thread.name = 'NetworkProbe'
+    thread.daemon = True
+    thread.start()
+    self._changed(False)
+    return True
+
+  def release(self):
+    with self._cond:
+      self.released = True
+      self._cond.notify_all()
+
+  def _run(self):
+    delay = self._delay
+    while True:
+      with self._cond:
+        if self._cond.wait_for(lambda: not self.open, delay):
+          return   # it is closed by response of other request
+      if self._probe():
+        self.success()
+      delay = min(delay * 2, self._delay_max)
+
+class _Bucket(object):
+  '''
+    Token bucket: tokens are added with rate per second, up to burst tokens can be accumulated.
+    The acquire method waits until requested number of tokens is available. Tokens are reserved
+    in order of calls, so waiting threads are served in FIFO manner. Zero rate means no limit.
+  '''
+  def __init__(self, rate, burst=None):
+    self.rate = rate
+    self._burst = burst or rate
+    self._tokens = self._burst
+    self._stamp = time()
+    self._lock = Lock()
+
+  def set(self, rate, burst=None):
+    ''' change the rate (and burst) of bucket'''
+    with self._lock:
+      self.rate = rate
+      self._burst = burst or rate
+      self._tokens = min(self._tokens, self._burst)
+
+  def acquire(self, n=1):
+    wait = self.reserve(n)
+    if wait > 0:
+      sleep(wait)
+
+  def reserve(self, n=1):
+    ''' reserve n tokens. Returns the time to wait until reserved tokens are available'''
+    if not self.rate:
+      return 0
+    with self._lock:
+      now = time()
+      self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self.rate) - n
+      self._stamp = now
+      return -self._tokens / self.rate
+
+class _Digest(object):
+  '''
+    sha256 and size of file that is written sequentially: data are hashed as they pass to the file
+    (update method). When writing continues from other position (seek method) then the data of
+    file that were not passed yet are read from the file, so each byte is hashed once.
+  '''
+  def __init__(self, path):
+    self._path = path
+    self._hash = sha256()
+    self.size = 0   # number of hashed bytes
+
+  def update(self, data):
+    self._hash.update(data)
+    self.size += len(data)
+
+  def seek(self, pos):
+    ''' writing continues from pos: hash the file data up to pos'''
+    if pos < self.size:
+      self._hash = sha256()
+      self.size = 0
+    if pos > self.size:
+      with open(self._path, 'rb') as f:
+        f.seek(self.size)
+        for chunk in iter(lambda: f.read(min(1 << 20, pos - self.size)), b''):
+          self.update(chunk)
+          if self.size == pos:
+            break
+
+  def hexdigest(self):
+    return self._hash.hexdigest()
+
+class _Limit(object):
+  '''
+    Bandwidth limit: token bucket of bytes with the rate (bytes per second, 0 - no limit) that can
+    depend on the time of day. schedule is a list of (start, end, rate) where start and end are
+    'HH:MM' of local time (the period can pass midnight). The rate of the first period that
+    includes current time is used, the default rate is used out of periods. When parent limit is
+    given then passed bytes are also taken from it (so per account limits share global limit).
+  '''
+  def __init__(self, rate=0, schedule=(), parent=None):
+    self._parent = parent
+    self._bucket = _Bucket(0)
+    self.set(rate, schedule)
+
+  def set(self, rate=0, schedule=()):
+    self._rate = rate
+    self._schedule = [(self._minutes(a), self._minutes(b), r) for a, b, r in schedule]
+
+  @staticmethod
+  def _minutes(hhmm):
+    h, m = hhmm.split(':')
+    return int(h) * 60 + int(m)
+
+  def active(self):
+    ''' returns True when this limit or parent limit is set'''
+    return bool(self._rate or self._schedule or self._parent is not None and self._parent.active())
+
+  def rate(self, t=None):
+    ''' returns the rate at local time t (default: now)'''
+    t = localtime(t)
+    now = t.tm_hour * 60 + t.tm_min
+    for a, b, rate in self._schedule:
+      if (a <= now < b) if a <= b else (now >= a or now < b):
+        return rate
+    return self._rate
+
+  def reserve(self, n):
+    ''' take n bytes. Returns time to wait until they are available'''
+    rate = self.rate()
+    if rate != self._bucket.rate:
+      self._bucket.set(rate)
+    wait = self._bucket.reserve(n)
+    return wait if self._parent is None else max(wait, self._parent.reserve(n))
+
+  def acquire(self, n):
+    wait = self.reserve(n)
+    if wait > 0:
+      sleep(wait)
+
+  CHUNK = 64 << 10   # size of data that are passed at once by limited transfer
+
+class _Body(object):
+  '''
+    Body of upload request: size bytes of open file f. The upload connection (_UpConnection) sends
+    it by sendfile when socket is plain TCP, so data go from page cache to socket in kernel. Via
+    TLS (or any other transport) it is read by big chunks into the reusable buffer buf and the
+    slices of buffer are sent, no bytes objects are made for the data. When bandwidth limit is
+    given then data are passed by chunks of limit.CHUNK bytes after the limit allows them.
+    The sending is interrupted by TimeoutError when socket doesn't accept data during stall
+    seconds or when it is not finished before the deadline (timeout attribute is set then).
+  '''
+  def __init__(self, f, buf, limit=None, stall=None, deadline=None):
+    self._file = f
+    self._buf = buf if limit is None else buf[:limit.CHUNK]
+    self._limit = limit
+    self._stall = stall         # maximal time of socket send without progress
+    self._deadline = deadline   # time when the sending should be finished
+    self.late = False           # sending is interrupted by deadline
+    self.timeout = False        # sending is interrupted by stall or deadline
+    self._size = file_info(f.fileno()).st_size
+    self.sent = 0     # number of passed bytes
+    f.seek(0)
+
+  def __len__(self):
+    return self._size
+
+  def read(self, n=-1):
+    n = min(len(self._buf) if n < 0 else n, len(self._buf), self._size - self.sent)
+    if n <= 0:
+      return b''
+    if self._limit is not None:
+      self._limit.acquire(n)
+    self._check()
+    n = self._file.readinto(self._buf[:n])
+    if not n:
+      raise OSError(EIO, 'file is truncated during upload')
+    self.sent += n
+    return self._buf[:n]
+
+  def _check(self):
+    if self._deadline is not None and time() > self._deadline:
+      self.late = True
+      raise TimeoutError('upload is too slow')
+
+  def send(self, sock):
+    try:
+      self._send(sock)
+    except TimeoutError:
+      self.timeout = True
+      raise
+
+  def _send(self, sock):
+    if self._stall is not None:
+      sock.settimeout(self._stall)
+    if type(sock) is socket:
+      step = (self._limit.CHUNK if self._limit is not None else
+              self._size if self._deadline is None else len(self._buf))
+      while self.sent < self._size:
+        n = min(step, self._size - self.sent)
+        if self._limit is not None:
+          self._limit.acquire(n)
+        self._check()
+        n = sock.sendfile(self._file, self.sent, n)
+        if not n:
+          raise OSError(EIO, 'file is truncated during upload')
+        self.sent += n
+    else:
+      data = self.read()
+      while data:
+        sock.sendall(data)
+        data = self.read()
+
+class _Send(object):
+  ''' connection mixin: request headers are sent as usual and _Body is sent by its send method'''
+  def request(self, method, url, body=None, headers=None, **kwargs):
+    if not isinstance(body, _Body):
+      return super().request(method, url, body, headers, **kwargs)
+    super().request(method, url, None, headers, **kwargs)   # Content-Length is set by requests
+    body.send(self.sock)
+
+class _UpConnection(_Send, HTTPConnection):
+  pass
+
+class _UpsConnection(_Send, HTTPSConnection):
+  pass
+
+class _UpPool(HTTPConnectionPool):
+  ConnectionCls = _UpConnection
+
+class _UpsPool(HTTPSConnectionPool):
+  ConnectionCls = _UpsConnection
+
+class _UpAdapter(HTTPAdapter):
+  ''' transport adapter of upload session: its connections send _Body without copying'''
+  def init_poolmanager(self, *args, **kwargs):
+    super().init_poolmanager(*args, **kwargs)
+    self.poolmanager.pool_classes_by_scheme = {'http': _UpPool, 'https': _UpsPool}
 
 class Cloud(object):
-  def __init__(self, token):
+  '''
+    Connection to the cloud is performed via persistent (keep-alive) HTTP sessions. There are
+    separate sessions (connection pools) for REST API host, for upload hosts and for download
+    hosts. The size of each pool is equal to the number of working threads that use the Cloud
+    object simultaneously.
+
+    Asynchronous operations (move, copy, delete of big folders, trash cleaning) are tracked by
+    the shared poller. When blocking attribute is False then task returns the Future instead of
+    the (status, result) tuple for such operations, and the calling thread is not blocked
+    until the operation is finished.
+
+    Optional config is a dictionary with account settings. Following keys are used here:
+      'baseurl'      - URL of REST API (default: BASEURL)
+      'workers'      - number of working threads (default: number of CPUs * 5 as in PoolExecutor)
+      'poll_min'     - initial interval of asynchronous operation status checks (default: 0.5 sec)
+      'poll_max'     - maximal interval of asynchronous operation status checks (default: 10 sec)
+      'poll_timeout' - maximal duration of asynchronous operation (default: 3600 sec)
+      'retry_time'   - maximal total time of retries of one request (default: 60 sec)
+      'retry_delay'  - initial backoff delay between retries (default: 0.5 sec)
+      'retry_delay_max' - maximal backoff delay between retries (default: 15 sec)
+      'retry_budget' - ratio of retries to requests (default: 0.2)
+      'retry_reserve' - maximal number of retries that can be stored in budget (default: 20)
+      'breaker_errors' - number of consecutive connection errors after which the network is
+                       considered lost and requests are parked until it is back (default: 5,
+                       0 - off)
+      'breaker_delay' - initial interval of network checks while it is lost (default: 1 sec)
+      'breaker_delay_max' - maximal interval of network checks while it is lost (default: 60 sec)
+      'rate_meta'    - limit of metadata requests per second (default: 0 - no limit)
+      'rate_href'    - limit of upload/download link requests per second (default: 0 - no limit)
+      'down_buffer'  - size of transfer buffer of thread (default: 4 MB)
+      'segment_min'  - minimal size of file that is downloaded by segments (default: 256 MB)
+      'segment_size' - size of one segment (default: 32 MB)
+      'segment_threads' - number of concurrently downloaded segments of one file (default: 4)
+      'bulk_threads' - number of concurrent requests of one 'res_many' call (default: 16)
+      'list_records' - 'list' returns compact records instead of dicts (default: False)
+      'list_window'  - number of pages of 'files' that are requested at once (default: 4)
+      'tree_threads' - number of folder pages of 'tree' that are requested at once (default: 8)
+      'metrics_interval' - interval of logging the requests statistics (default: 600 sec, 0 - off)
+      'cache_ttl'    - time of caching of 'info' and 'last' results (default: 10 sec, 0 - off)
+      'prefetch'     - number of transfer links that are requested in advance (default: 8)
+      'href_ttl'     - time while prefetched transfer link is used (default: 60 sec)
+      'trace'        - path of file to record all requests and responses (see CloudTrace)
+      'replay'       - path of recorded trace: responses are taken from it without network
+      'replay_scale' - multiplier of recorded latencies in replay (default: 1, 0 - no delays)
+      'timeout_connect' - timeout of connection establishing (default: 10 sec)
+      'timeout_read' - maximal time of waiting for API response data (default: 30 sec)
+      'timeout_stall' - maximal time of data transfer without any progress (default: 60 sec)
+      'timeout_slow' - transfer is interrupted when it takes timeout_slow times longer than it is
+                       expected by measured throughput of previous transfers (default: 10, 0 - off)
+      'bw_up'        - upload bandwidth limit in bytes per second (default: 0 - no limit)
+      'bw_down'      - download bandwidth limit in bytes per second (default: 0 - no limit)
+      'bw_schedule'  - list of [start, end, up, down]: other limits within the period of day
+                       from start till end ('HH:MM' of local time), e.g. [['01:00', '07:00', 0, 0]]
+
+    The limits of account are applied together with the global limits (see bandwidth method).
+    All transfers of all threads take the data from the same limits.
+
+    Requests that exceed timeouts are handled as failed requests (they are retried according to
+    the retry policy), so the stalled connection can't block the working thread forever.
+
+    When the network is lost (several connection errors in a row) the requests are parked
+    instead of failing: they wait until the network check ('info' request) succeeds and then
+    they continue. The network method is called on such changes (it can be redefined).
+  '''
+  def __init__(self, token, config=None):
+    self.config = config or {}
+    self.workers = self.config.get('workers') or (cpu_count() or 1) * 5
+    self.baseurl = self.config.get('baseurl', self.BASEURL)
     # make headers for requests that require authorization
     self._headers = {'Accept': 'application/json', 'Authorization': token}
+    # record or replay of HTTP sessions
+    trace, replay = self.config.get('trace'), self.config.get('replay')
+    self._recorder = Recorder(trace) if trace and not replay else None
+    self._player = Player(replay, self.config.get('replay_scale', 1)) if replay else None
+    # separate connection pools for API host, upload hosts and download hosts
+    self._bulk_threads = self.config.get('bulk_threads', 16)
+    self._api = self._session(1, self.workers + self._bulk_threads)
+    self._api.headers.update(self._headers)
+    self._up = self._session(10, data=True, up=True)
+    self._down = self._session(10, data=True)
+    # circuit breaker of network connection and retry policy for transient failures
+    self._breaker = _Breaker(self.config.get('breaker_errors', 5),
+                             self.config.get('breaker_delay', 1),
+                             self.config.get('breaker_delay_max', 60),
+                             lambda: self.probe() is not None, lambda online: self.network(online))
+    self._retry = _Retry(self.config.get('retry_time', 60), self.config.get('retry_delay', 0.5),
+                         self.config.get('retry_delay_max', 15),
+                         self.config.get('retry_budget', 0.2), self.config.get('retry_reserve', 20),
+                         self._breaker)
+    # request rate limits (shared by all threads): separate for metadata and transfer links
+    self._rate = _Bucket(self.config.get('rate_meta', 0))
+    self._rate_href = _Bucket(self.config.get('rate_href', 0))
+    # requests statistics
+    self._metrics = _Metrics(self.config.get('metrics_interval', 600))
+    # timeouts (connect, read) of API requests and of data transfers
+    connect = self.config.get('timeout_connect', 10)
+    self._timeout = (connect, self.config.get('timeout_read', 30))
+    self._stall = (connect, self.config.get('timeout_stall', 60))
+    self._slow = self.config.get('timeout_slow', 10)
+    self._speed = {'up': 0, 'down': 0}   # measured throughput of transfers (bytes per second)
+    # shared poller of asynchronous operations
+    self._poller = _Poller(self._api, self._rate, self.config.get('poll_min', 0.5),
+                           self.config.get('poll_max', 10), self.config.get('poll_timeout', 3600),
+                           self._timeout)
+    self.blocking = True  # wait for finish of asynchronous operations in task
+    # transfer buffers are allocated once per thread and reused by all transfers in this thread
+    self._buffers = local()
+    self._buffer_size = self.config.get('down_buffer', 4 << 20)
+    # bulk requests executor and requests in flight (for collapsing of the same requests)
+    self._bulk = ThreadPoolExecutor(self._bulk_threads)
+    self._flight = dict()
+    self._flight_lock = Lock()
+    self._records = self.config.get('list_records', False)
+    self._window = self.config.get('list_window', 4)
+    self._tree_threads = self.config.get('tree_threads', 8)
+    # cached results of 'info' and 'last'
+    self._cache = _Cache(self.config.get('cache_ttl', 10), self._bulk)
+    # transfer links requested in advance
+    self._prefetch = self.config.get('prefetch', 8)
+    self._href_ttl = self.config.get('href_ttl', 60)
+    self._links = dict()            # {(cmd, path): (request time, Future of request result)}
+    self._wanted = OrderedDict()    # queue of transfers that are waiting for links {(cmd, path)}
+    self._links_lock = Lock()
+    # bandwidth limits of account (they share the global limits of all accounts)
+    schedule = self.config.get('bw_schedule', ())
+    self._bw_up = _Limit(self.config.get('bw_up', 0), [(a, b, up) for a, b, up, _ in schedule],
+                         self.BANDWIDTH['up'])
+    self._bw_down = _Limit(self.config.get('bw_down', 0),
+                           [(a, b, down) for a, b, _, down in schedule], self.BANDWIDTH['down'])
+    # segmented download parameters
+    self._segment_min = self.config.get('segment_min', 256 << 20)
+    self._segment_size = self.config.get('segment_size', 32 << 20)
+    self._segment_threads = self.config.get('segment_threads', 4)
+
+  BANDWIDTH = {'up': _Limit(), 'down': _Limit()}  # global bandwidth limits of all accounts
+
+  @classmethod
+  def bandwidth(cls, up=0, down=0, schedule=()):
+    ''' Set the global bandwidth limits (bytes per second, 0 - no limit) for all Cloud objects.
+        schedule is a list of [start, end, up, down] like 'bw_schedule' config value.
+    '''
+    cls.BANDWIDTH['up'].set(up, [(a, b, u) for a, b, u, _ in schedule])
+    cls.BANDWIDTH['down'].set(down, [(a, b, d) for a, b, _, d in schedule])
+
+  def network(self, online):
+    ''' It is called when the network is lost (online is False) and when it is back (online is
+        True). It can be redefined to react on these changes.
+    '''
+    pass
+
+  def probe(self):
+    ''' Check the connection by one 'info' request without retries. Returns True when API answers
+        successfully, False when it answers with error and None when it is not reachable.
+    '''
+    method, url, code = self.CMD['info']
+    start = time()
+    try:
+      r = self._api.request(method, self.baseurl + url, timeout=self._timeout)
+    except requests.RequestException as e:
+      self._metrics.record('probe', time() - start, e.__class__.__name__)
+      return None
+    self._metrics.record('probe', time() - start, r.status_code)
+    self._breaker.success()
+    return r.status_code == code
+
+  def release(self):
+    ''' Make the requests that are parked while the network is lost (and new ones) fail at once
+        until the network is back.
+    '''
+    self._breaker.release()
+
+  def pending(self):
+    ''' returns number of unfinished asynchronous operations'''
+    return self._poller.outstanding()
+
+  def metrics(self):
+    ''' Returns statistics of requests: {name: {'count', 'errors', 'time', 'max', 'bytes', 'hist',
+        'status'}, 'poll': poller statistics, 'retries': total number of retries}. The name is
+        command ('up-href' and 'down-href' for requests of transfer links) or 'up-transfer' and
+        'down-transfer' for data transfers. 'hist' is number of requests by latency buckets
+        (upper bounds are in _Metrics.BOUNDS), 'status' is number of requests by status code.
+    '''
+    res = self._metrics.snapshot()
+    res['poll'] = self._poller.stats()
+    res['retries'] = self._retry.retries
+    return res
+
+  def prefetch(self, cmd, path):
+    ''' Request the link for 'up' or 'down' transfer of path in advance, while previous transfers
+        are in progress. Not more than 'prefetch' links are requested or kept at once, the rest
+        are waiting in the queue. Prefetched link is used by the next transfer of path when it is
+        not older than href_ttl seconds, otherwise the new link is requested by transfer.
+    '''
+    with self._links_lock:
+      self._wanted[(cmd, path)] = None
+    self._pump()
+
+  def _pump(self):
+    ''' start link requests for queued transfers while there are free places'''
+    now = time()
+    with self._links_lock:
+      for key in [key for key, (t, _) in self._links.items() if now - t > self._href_ttl]:
+        del self._links[key]   # expired link
+      while self._wanted and len(self._links) < self._prefetch:
+        key = self._wanted.popitem(last=False)[0]
+        if key not in self._links:
+          self._links[key] = (now, self._bulk.submit(self._request, *key))
+
+  def _release(self, cmd, path):
+    ''' returns prefetched link request (time, Future) of transfer or None'''
+    with self._links_lock:
+      self._wanted.pop((cmd, path), None)
+      link = self._links.pop((cmd, path), None)
+    self._pump()
+    return link
+
+  def _link(self, cmd, path):
+    ''' returns result of link request (prefetched or new) and flag of prefetched link'''
+    link = self._release(cmd, path)
+    if link is not None and time() - link[0] <= self._href_ttl:
+      return link[1].result(), True
+    return self._request(cmd, path), False
+
+  EXPIRED = {403, 404, 410}  # transfer statuses that can be caused by expired link
+
+  METRIC = {'up': 'up-href', 'down': 'down-href'}  # metrics names of commands
+
+  def _call(self, cmd, func):
+    ''' perform request via func() with retries and register it in metrics'''
+    start = time()
+    name = self.METRIC.get(cmd, cmd)
+    try:
+      r = self._retry.call(cmd, func)
+    except Exception as e:
+      self._metrics.record(name, time() - start, e.__class__.__name__)
+      raise
+    self._metrics.record(name, time() - start, r.status_code)
+    return r
+
+  def _then(self, res, func):
+    ''' call func(status, result) with res - tuple (status, result) or Future of such tuple.
+        When res is Future then it returns the new Future that is resolved by result of func.
+    '''
+    if isinstance(res, Future):
+      ft = Future()
+      res.add_done_callback(lambda f: ft.set_result(func(*f.result())))
+      return ft
+    return func(*res)
+
+  def _session(self, hosts, size=None, data=False, up=False):
+    ''' make the new HTTP session with connection pools for <hosts> different hosts'''
+    s = requests.Session()
+    pools = {'pool_connections': hosts, 'pool_maxsize': size or self.workers}
+    if self._player is not None:
+      adapter = ReplayAdapter(self._player, **pools)
+    elif self._recorder is not None:
+      adapter = RecordAdapter(self._recorder, data, **pools)
+    elif up:
+      adapter = _UpAdapter(**pools)
+    else:
+      adapter = HTTPAdapter(**pools)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    return s
 
   BASEURL = 'https://cloud-api.yandex.net/v1/disk'
-  # cmd : (method, url, success ret_code)
-  CMD = {'info':  (requests.get, BASEURL + '?fields=total_space%2Ctrash_size%2Cused_space', 200),
-         'last':  (requests.get, BASEURL + '/resources/last-uploaded?limit=10&fields=path', 200),
-         'res':   (requests.get, BASEURL + '/resources?path={}'
+  # cmd : (method, url relative to BASEURL, success ret_code)
+  CMD = {'info':  ('GET', '?fields=total_space%2Ctrash_size%2Cused_space', 200),
+         'last':  ('GET', '/resources/last-uploaded?limit=10&fields=path', 200),
+         'res':   ('GET', '/resources?path={}'
                    '&fields=size%2Cmodified%2Csha256%2Cpath%2Ctype%2Ccustom_properties', 200),
-         'list':  (requests.get, BASEURL + '/resources/files?limit={}&offset={}', 200),
-         'prop':  (requests.patch, BASEURL + '/resources/?path={}'
+         'list':  ('GET', '/resources/files?limit={}&offset={}'
+                   '&fields=items.path%2Citems.type%2Citems.modified%2Citems.sha256%2Citems.size'
+                   '%2Citems.custom_properties', 200),
+         'dir':   ('GET', '/resources?path={}&limit={}&offset={}'
+                   '&fields=_embedded.items.path%2C_embedded.items.type%2C_embedded.items.modified'
+                   '%2C_embedded.items.sha256%2C_embedded.items.size'
+                   '%2C_embedded.items.custom_properties%2C_embedded.total', 200),
+         'prop':  ('PATCH', '/resources/?path={}'
                    '&fields=path%2Ccustom_properties', 200),
-         'mkdir': (requests.put, BASEURL + '/resources?path={}', 201, ),
-         'del':   (requests.delete, BASEURL + '/resources?path={}', 204),
-         'trash': (requests.delete, BASEURL + '/trash/resources', 204),
-         'move':  (requests.post, BASEURL + '/resources/move?path={}&from={}', 201),
-         'copy':  (requests.post, BASEURL + '/resources/copy?path={}&from={}', 201),
-         'up':    (requests.get, BASEURL + '/resources/upload?path={}&overwrite=true', 200),
-         'down':  (requests.get, BASEURL + '/resources/download?path={}', 200)}
+         'mkdir': ('PUT', '/resources?path={}', 201, ),
+         'del':   ('DELETE', '/resources?path={}', 204),
+         'trash': ('DELETE', '/trash/resources', 204),
+         'move':  ('POST', '/resources/move?path={}&from={}', 201),
+         'copy':  ('POST', '/resources/copy?path={}&from={}', 201),
+         'up':    ('GET', '/resources/upload?path={}&overwrite=true', 200),
+         'down':  ('GET', '/resources/download?path={}', 200)}
 
   def _request(self, cmd, *args, **kwargs):
     ''' format URL, perform request and handle asynchronous operations'''
     method, url, code = self.CMD[cmd]
-    r = method(url.format(*args), **kwargs, headers=self._headers)
+    url = self.baseurl + url.format(*args)
+    bucket = self._rate_href if cmd in ('up', 'down') else self._rate
+    def req():
+      bucket.acquire()  # wait for the rate limit
+      return self._api.request(method, url, timeout=self._timeout, **kwargs)
+    try:
+      r = self._call(cmd, req)
+    except requests.RequestException as e:
+      return False, self._exception(e)
+    self._metrics.add(self.METRIC.get(cmd, cmd), len(r.content))
     status_code = r.status_code
     result = r.json() if r.text else ''
     if status_code == 202:  # it is asynchronous operation
-      url = result['href']
-      while True:
-        sleep(0.777)  # reasonable pause between continuous requests
-        r = requests.get(url, headers=self._headers)
-        st = r.status_code
-        res = r.json() if r.text else ''
-        if st == 200:
-          if res.get("status") == "success":
-            status_code = code
-            break
-          if res.get("status") == "failed":
-            status_code = 404
-            result = {'error': 'FailedAsyncOperationError'}
-            break
-        else:
-          status_code = st
-          result = res
-          break
+      ft = self._poller.add(result['href'], code)
+      return ft.result() if self.blocking else ft
     ok = status_code == code
     if not ok:
       result['code'] = status_code  # add status code into error description
     return ok, result
 
+  def _open(self, cmd, *args):
+    ''' perform GET request with streamed body. Returns (True, response) or (False, error)'''
+    method, url, code = self.CMD[cmd]
+    url = self.baseurl + url.format(*args)
+    def req():
+      self._rate.acquire()  # wait for the rate limit
+      return self._api.request(method, url, stream=True, timeout=self._timeout)
+    try:
+      r = self._call(cmd, req)
+    except requests.RequestException as e:
+      return False, self._exception(e)
+    if r.status_code == code:
+      return True, r
+    try:
+      result = r.json() if r.text else dict()
+    except (ValueError, requests.RequestException) as e:
+      result = self._exception(e)
+    result['code'] = r.status_code  # add status code into error description
+    return False, result
+
+  def _list(self, chunk, offset):
+    ''' start 'items' request, returns (True, generator of items) or error'''
+    status, r = self._open('list', chunk, offset)
+    if not status:
+      return self._done('items', (chunk, offset), False, r)
+    return True, self._items(r, chunk, offset)
+
+  def _items(self, r, chunk, offset):
+    ''' Generator of (status, item) for items of response r that are parsed as they arrive.
+        Broken transfer is resumed by new request starting from the first not received item.
+    '''
+    got = 0
+    start = self._retry.start()
+    attempt = 0
+    try:
+      while True:
+        parser = _Items()
+        try:
+          for data in r.iter_content(self.CHUNK):
+            self._metrics.add('list', len(data))
+            for item in self._format('list', {'items': parser.feed(data)}, self._records):
+              got += 1
+              yield True, item
+          if parser.done:
+            return
+          raise requests.exceptions.ChunkedEncodingError('list of items is incomplete')
+        except requests.RequestException as e:
+          r.close()
+          delay = self._retry.delay('list', attempt, start)
+          if delay is None or got >= chunk:
+            yield self._done('items', (chunk, offset), False, self._exception(e))
+            return
+          warning('items: retry #%d in %.1f sec after %s' % (attempt + 1, delay, e))
+          sleep(delay)
+          attempt += 1
+          status, res = self._open('list', chunk - got, offset + got)
+          if not status:
+            yield self._done('items', (chunk, offset), False, res)
+            return
+          r = res
+    finally:
+      r.close()
+
+  def _files(self, chunk, window=None):
+    ''' Generator of (status, item) for all files. The number of files is not known in advance, so
+        window pages of chunk items are requested at once: the head page is streamed by the
+        calling thread (its items are yielded as they arrive, like 'items' does) and the pages
+        behind it are received by bulk threads. The next page is requested when the head one is
+        taken. Items are yielded in the order of pages. Listing stops after the short page or the
+        error, the pages requested after it are dropped. Not more than window pages are kept in
+        memory.
+    '''
+    pages = deque()   # Futures of pages behind the head page
+    offset = 0        # offset of the head page
+    head = None       # items of the head page (None - it is not requested yet)
+    try:
+      while True:
+        while len(pages) < (window or self._window) - 1:
+          pages.append(self._bulk.submit(self._page, chunk, offset + chunk * (len(pages) + 1)))
+        if head is None:
+          status, head = self._list(chunk, offset)
+          if not status:
+            head = [(status, head)]
+        got = 0
+        item = (False, None)
+        for item in head:
+          got += 1
+          yield item
+        if got < chunk or not item[0]:
+          return
+        offset += chunk
+        head = pages.popleft().result() if pages else None
+    finally:
+      for ft in pages:
+        ft.cancel()
+
+  def _page(self, chunk, offset):
+    ''' returns the list of (status, item) of one page (the last one is error of failed request)'''
+    status, result = self._list(chunk, offset)
+    return list(result) if status else [(status, result)]
+
+  def _tree(self, path='/', chunk=1000):
+    ''' Generator of (status, item) for all files and folders within path. Folders are walked in
+        breadth-first order: the page of folder is requested by bulk thread and the folders found
+        in it are queued. The total number of items of folder is known from its first page, so
+        the rest pages are queued at once. Not more than tree_threads pages are requested or kept
+        at once, items are yielded in the order of queue. Walk stops after the first error.
+    '''
+    queue = deque([(path, 0)])    # folder pages to request
+    pages = deque()               # requested pages (folder, offset, Future)
+    try:
+      while queue or pages:
+        while queue and len(pages) < self._tree_threads:
+          folder, offset = queue.popleft()
+          pages.append((folder, offset, self._bulk.submit(self._request, 'dir', quote(folder),
+                                                          chunk, offset)))
+        folder, offset, ft = pages.popleft()
+        status, result = ft.result()
+        if status and '_embedded' not in result:   # the path is a file
+          status, result = False, {'code': -1, 'error': 'NotADirectoryError', 'path': folder,
+                                   'description': 'the path is not a folder'}
+        if not status:
+          yield self._done('tree', (path,), status, result)
+          return
+        result = result['_embedded']
+        if offset == 0:
+          queue.extend((folder, o) for o in range(chunk, result['total'], chunk))
+        for item in self._format('list', result, self._records):
+          if item['type'] == 'dir':
+            queue.append((item['path'], 0))
+          yield True, item
+    finally:
+      for folder, offset, ft in pages:
+        ft.cancel()
+
+  def _buffer(self):
+    ''' returns the transfer buffer of current thread'''
+    buf = getattr(self._buffers, 'buf', None)
+    if buf is None:
+      buf = self._buffers.buf = memoryview(bytearray(self._buffer_size))
+    return buf
+
+  CHUNK = 64 << 10     # initial (minimal) size of download chunk
+  CHUNK_TIME = 0.05    # desired duration of one chunk reading
+
+  def _receive(self, r, write):
+    ''' Pass the body of streamed response r to write function (like write method of file).
+        Data are read directly into the big reusable buffer. The size of chunk is adjusted
+        according to measured throughput: it is doubled while reading of chunk takes less than
+        CHUNK_TIME and it is halved when it takes more than 2 * CHUNK_TIME. When download
+        bandwidth is limited then chunk is not bigger than _Limit.CHUNK and the next chunk is not
+        read until the limit allows it. The transfer that is too slow (see _deadline) is
+        interrupted by ReadTimeout.
+        Returns tuple (number of received bytes, transfer time in seconds).
+    '''
+    buf = self._buffer()
+    limit = self._bw_down if self._bw_down.active() else None
+    if limit is not None:
+      buf = buf[:limit.CHUNK]
+    r.raw.decode_content = True
+    chunk = self.CHUNK
+    size = 0
+    start = stamp = time()
+    deadline = self._deadline('down', int(r.headers.get('Content-Length') or 0))
+    try:
+      while True:
+        try:
+          n = r.raw.readinto(buf[:chunk])
+        except ProtocolError as e:    # translate errors like Response.iter_content does
+          raise requests.exceptions.ChunkedEncodingError(e)
+        except ReadTimeoutError as e:   # stalled transfer is not a connection error (see _Retry)
+          raise requests.exceptions.ReadTimeout(e)
+        except DecodeError as e:
+          raise requests.exceptions.ContentDecodingError(e)
+        if not n:
+          break
+        write(buf[:n])
+        size += n
+        if limit is not None:
+          limit.acquire(n)
+        now = time()
+        if deadline is not None and now > deadline:
+          self._measure('down', size, now - start, True)
+          raise requests.exceptions.ReadTimeout('download is too slow')
+        if now - stamp < self.CHUNK_TIME:
+          chunk = min(chunk * 2, len(buf))
+        elif now - stamp > self.CHUNK_TIME * 2:
+          chunk = max(chunk // 2, self.CHUNK)
+        stamp = now
+    finally:
+      self._metrics.add('down-transfer', size)
+    self._measure('down', size, time() - start)
+    return size, time() - start
+
+  MEASURE_MIN = 1 << 20   # minimal size of transfer that is used to measure throughput
+  PROCESS_RATE = 50 << 20   # assumed minimal speed of processing of uploaded data by server
+
+  def _measure(self, kind, size, sec, slow=False):
+    ''' Update the measured throughput of transfers of kind ('up' or 'down'). slow is True when
+        the transfer was interrupted as too slow: its speed is used whatever its size, so the
+        expectations go down when the network becomes slower.
+    '''
+    if (slow or size >= self.MEASURE_MIN) and sec > 0:
+      speed = self._speed[kind]
+      self._speed[kind] = size / sec if not speed else speed * 0.7 + size / sec * 0.3
+
+  def _deadline(self, kind, size):
+    ''' Returns the time when the transfer of size bytes should be finished or None. The transfer
+        is expected to take size / measured throughput seconds, it is given timeout_slow times
+        more (plus timeout_stall). Transfers are not limited until the throughput is measured and
+        while the bandwidth limit is active (such transfers are slow intentionally).
+    '''
+    speed = self._speed[kind]
+    limit = self._bw_up if kind == 'up' else self._bw_down
+    if not (self._slow and speed and size) or limit.active():
+      return None
+    return time() + self._stall[1] + self._slow * size / speed
+
+  def _fetch(self, name, href, lpath, resume, size=None, digest=None):
+    ''' Download file from href to lpath. Returns the response of the last transfer request.
+        When resume is True then downloading continues from the end of existing local file.
+        The file that is bigger than segment_min is downloaded by concurrent segments.
+        Received data are passed to digest (_Digest of lpath) when it is given.
+    '''
+    def get():
+      nonlocal resume
+      # request the rest of file when some part of it is already received
+      offset = file_info(lpath).st_size if resume and pathExists(lpath) else 0
+      resume = True   # each retry continues from the last received byte
+      # make secondary request to transfer data
+      r = self._down.get(href, stream=True, timeout=self._stall,
+                         headers={'Range': 'bytes=%d-' % offset} if offset else None)
+      if r.status_code in (200, 206):
+        # write to local file
+        start = self._range(r)[0] if r.status_code == 206 else 0
+        with open(lpath, 'r+b' if start else 'wb') as f:
+          f.seek(start)
+          f.truncate()
+          write = f.write
+          if digest is not None:
+            digest.seek(start)
+            def write(data):
+              f.write(data)
+              digest.update(data)
+          size, sec = self._receive(r, write)
+        info('down %s: %d bytes from %d in %.3f sec (%.1f MB/s)' %
+             (name, size, start, sec, size / (sec or 1e-6) / 1048576))
+      elif r.status_code == 416 and self._range(r)[2] == offset:
+        r.status_code = 206   # file was completely received before
+      return r
+
+    if size and self._segment_threads > 1:
+      offset = file_info(lpath).st_size if resume and pathExists(lpath) else 0
+      if size - offset > self._segment_min:
+        r = self._fetchSegments(name, href, lpath, offset, size)
+        if r.status_code != 200:
+          return r
+        r.close()   # server ignores Range: download file by single stream
+    return self._call('down-transfer', get)
+
+  def _fetchSegments(self, name, href, lpath, offset, size):
+    ''' Download bytes from offset up to size of file by concurrent range requests. Segments are
+        written to their places in file by positional writes. When some segment fails, the file
+        is truncated to the end of continuous received part to make it valid for resume.
+        The rest segments are requested after the response to the first one shows that the
+        server supports Range. Returns the response of failed request or the response of the last
+        segment (status 200 means that server ignores Range).
+    '''
+    seg = self._segment_size
+    parts = [[a, min(a + seg, size), 0] for a in range(offset, size, seg)]  # start, end, received
+    stop = False
+
+    def request(part):
+      return self._down.get(href, stream=True, timeout=self._stall,
+                            headers={'Range': 'bytes=%d-%d' % (part[0] + part[2], part[1] - 1)})
+
+    def fetch(part, started=None):
+      def get():
+        if stop:
+          raise _Canceled()
+        resp = request(part)
+        if resp.status_code == 206:
+          if started is not None:
+            started()
+          def write(data):
+            while data:
+              if stop:
+                raise _Canceled()
+              n = pwrite(fd, data, part[0] + part[2])
+              part[2] += n
+              data = data[n:]
+          self._receive(resp, write)
+          if part[0] + part[2] < part[1]:
+            raise requests.exceptions.ChunkedEncodingError('incomplete segment %d-%d' % tuple(part[:2]))
+        return resp
+      return self._call('down-transfer', get)
+
+    start = time()
+    fts = []
+    with open(lpath, 'r+b' if offset else 'wb') as f:
+      fd = f.fileno()
+      pool = ThreadPoolExecutor(self._segment_threads - 1)
+
+      def started():   # Range is supported: request the rest segments
+        if not fts:
+          f.truncate(size)
+          fts.extend(pool.submit(fetch, p) for p in parts[1:])
+
+      try:
+        r = fetch(parts[0], started)
+        for ft in fts:
+          if r.status_code != 206:
+            break
+          r = ft.result()
+      except BaseException:
+        r = None
+        raise
+      finally:
+        if r is None or r.status_code != 206:
+          stop = True
+          pool.shutdown(wait=True, fast=True)
+          end = offset   # end of continuous received part
+          for a, b, n in parts:
+            end = a + n
+            if end < b:
+              break
+          f.truncate(end)
+        else:
+          pool.shutdown(wait=False)
+    if r.status_code == 206:
+      sec = time() - start
+      info('down %s: %d bytes from %d by %d segments in %.3f sec (%.1f MB/s)' %
+           (name, size - offset, offset, len(parts), sec, (size - offset) / (sec or 1e-6) / 1048576))
+    return r
+
+  @staticmethod
+  def _range(r):
+    ''' returns tuple (first, last, total) from Content-Range header of response r'''
+    m = fullmatch(r'bytes (\d+|\*)-?(\d*)/(\d+|\*)', r.headers.get('Content-Range', '').strip())
+    if m is None:
+      return 0, None, None
+    return tuple(int(v) if v.isdigit() else None for v in m.groups())
+
+  @staticmethod
+  def _exception(e):
+    ''' make error description for failed request'''
+    return {'code': -1, 'error': e.__class__.__name__, 'description': str(e)}
+
   def task(self, cmd, *args, **kwargs):
     '''
       Universal disk operation. It can be called with following parameters:
       - 'info'                    : to retrieve the common disk information,
       - 'last'                    : to retrieve 10 last updeted files,
       - 'res', path               : to retrieve file|folder properties,
+      - 'res_many', paths         : to retrieve properties of many files|folders concurrently,
       - 'list', <chunk>, <offset> : returns <chunk> files starting from <ofset> from full file list,
+      - 'items', <chunk>, <offset>: the same as 'list' but items are parsed as they arrive,
+      - 'files', <chunk>[, <window>]: all files by pages of <chunk> items, <window> pages are
+                                    requested at once (default: 'list_window' config value),
+      - 'tree', path[, <chunk>]   : all files and folders (including empty ones) within path,
+                                    folders are listed by pages of <chunk> items (default: 1000),
       - 'prop', path, pr=val,...  : to set custom properties for file/folder,
       - 'mkdir', path             : to create a new folder,
       - 'del', path               : to delete file/folder,
       - 'trash'                   : to clean the trash,
       - 'move', pathto, pathfrom  : to move file/foldet from pathfrom to pathto,
       - 'copy', pathto, pathfrom  : to move file/foldet from pathfrom to pathto,
+                                    (with overwrite=True for 'move' and 'copy' the existing
+                                    pathto is replaced)
       - 'up', path, localpath     : to upload file from localpath of local disk to path on cloud
       - 'down', path, localpath   : to download file from path on cloud to localpath on local disk
+                                    (with resume=True the data that already are in localpath
+                                    are kept and the rest of file is requested; with size=<file
+                                    size> big file is downloaded by concurrent segments;
+                                    with sha256=<hex digest> the received data are hashed as
+                                    they arrive and download fails with ChecksumMismatchError
+                                    when the digest of file is different)
 
-      It always return the tuple (status, result).
+      It always return the tuple (status, result) or (when blocking is False) the Future of such
+      tuple for asynchronous 'del', 'trash', 'move' and 'copy' operations.
       When status True then result is the result of request. It varies for different operations:
       - dict with keys: total_space, trash_size, used_space                    : for 'info',
       - list of 10 paths                                                       : for 'last',
       - dict with keys: path, type, size, sha256, modified, custom_properties  : for 'res',
-      - list of dicts like dict forres                                         : for 'list',
+      - list of dicts like dict for 'res' (or records if 'list_records' set)   : for 'list',
+      - dict {path: (status, result of 'res' for path)}                        : for 'res_many',
+      - generator of (status, item) where item is like item of 'list'          : for 'items',
+                                                                                 'files', 'tree',
       - tuple (cmd, *args)                                                     : for all rest.
 
+      Simultaneous 'res' requests for the same path are collapsed into one request.
+      Results of 'info' and 'last' are cached for cache_ttl seconds. The cached result is
+      refreshed in background when it is expired and it is dropped when the disk content is
+      changed by 'up', 'del', 'trash', 'move' or 'copy'.
+
       If status False then it returns tuple(cmd, *args, error_dict), where error_dict contain
       at least 'code': <request status code>, 'error': <Error_identity_string>
     '''
 
+    # handle bulk and collapsed requests
+    if cmd == 'res_many':
+      return True, self._many(*args)
+    if cmd == 'items':
+      return self._list(*args)
+    if cmd == 'files':
+      return True, self._files(*args)
+    if cmd == 'tree':
+      return True, self._tree(*args)
+    if cmd == 'res':
+      return self._single(args[0], lambda: self._task(cmd, *args, **kwargs))
+    # handle cached requests and requests that change cached information
+    if cmd in ('info', 'last'):
+      return self._cache.get(cmd, lambda: self._task(cmd))
+    if cmd in ('up', 'del', 'trash', 'move', 'copy'):
+      return self._then(self._task(cmd, *args, **kwargs), self._changed)
+    return self._task(cmd, *args, **kwargs)
+
+  def _changed(self, status, result):
+    ''' drop cached information after the change of disk content'''
+    self._cache.invalidate()
+    return status, result
+
+  def _task(self, cmd, *args, **kwargs):
     # handle input parameters
     if cmd in ('up', 'down'):
       # remove local path from args for upload and download operations
       lpath = args[1]
       args = (args[0],)
+      resume = kwargs.pop('resume', False)
+      size = kwargs.pop('size', None)
+      sha = kwargs.pop('sha256', None)
     elif cmd == 'prop':
       kwargs = {'data': dumps({"custom_properties": kwargs})}
+    elif cmd in ('move', 'copy'):
+      kwargs = {'params': {'overwrite': 'true'}} if kwargs.get('overwrite') else {}
 
-    # perform request
-    status, result = self._request(cmd, *args, **kwargs)
+    # perform request (link of transfer can be requested in advance)
+    if cmd in ('up', 'down'):
+      result, prefetched = self._link(cmd, args[0])
+    else:
+      result = self._request(cmd, *args, **kwargs)
+    if isinstance(result, Future):  # asynchronous operation is still in progress
+      return self._then(result, lambda status, result: self._done(cmd, args, status, result))
+    status, result = result
 
     # handle (pass) some errors
     if not status and cmd == 'mkdir' and result['error'] == 'DiskPathPointsToExistentDirectoryError':
@@ -126,66 +1475,143 @@ class Cloud(object):
 
       # Upload
       elif cmd == 'up':
+        href = result['href']
         try:  # try to open and upload file
           with open(lpath, 'rb') as f:
+            def put():
+              # file is sent from the start by each attempt
+              body = _Body(f, self._buffer(), self._bw_up if self._bw_up.active() else None,
+                           self._stall[1], self._deadline('up', file_info(f.fileno()).st_size))
+              start = time()
+              try:
+                # server answers after it processes the data
+                r = self._up.put(href, data=body, timeout=(self._stall[0], self._stall[1] +
+                                                           len(body) / self.PROCESS_RATE))
+              except requests.ConnectionError as e:
+                if body.timeout:   # slow transfer is not a connection error (see _Retry)
+                  raise requests.exceptions.Timeout(e)
+                raise
+              finally:
+                self._metrics.add('up-transfer', body.sent)
+                if body.late:
+                  self._measure('up', body.sent, time() - start, True)
+              if r.status_code in (201, 200):
+                self._measure('up', body.sent, time() - start)
+              return r
             # make secondary request to transfer data
-            r = requests.put(result['href'], data = f)
-
+            r = self._call('up-transfer', put)
+          if r.status_code in (201, 200):
+            return True, (cmd, *args)
+          if prefetched and r.status_code in self.EXPIRED:
+            return self._task(cmd, args[0], lpath)   # repeat with the new link
+          # prepare error description for secondary request
+          result = r.json() if r.text else dict()
+          result['code'] = r.status_code
+        except requests.RequestException as e:   # it is OSError too: handle it first
+          result = self._exception(e)
         except OSError as e:
-          # prepare error description for failed file/socket operation
-          result = {'error': 'OSError', 'path': lpath, 'errno': e.errno, 'description': e.strerror}
-        if r.status_code in (201, 200):
-          return True, (cmd, *args)
-        # prepare error description for secondary request
-        result = r.json() if r.text else dict()
-        result['code'] = r.status_code
+          # prepare error description for failed file operation
+          result = {'code': -1, 'error': 'OSError', 'path': lpath,
+                    'errno': e.errno, 'description': e.strerror}
         # do not return here, handle error in section below
 
       # Download
       elif cmd == 'down':
-        # make secondary request to transfer data
-        r = requests.get(result['href'], stream=True)
-        # try open and write to local file
         try:
-          with open(lpath, 'wb') as f:
-            for chunk in r.iter_content(2048):
-              f.write(chunk)
+          # replayed data are synthetic: they can't be checked against the cloud sha256
+          digest = None if sha is None or self._player is not None else _Digest(lpath)
+          r = self._fetch(args[0], result['href'], lpath, resume, size, digest)
+          if r.status_code in (200, 206):
+            if digest is None:
+              return True, (cmd, *args)
+            digest.seek(file_info(lpath).st_size)  # hash the data that were not passed through
+            if digest.hexdigest() == sha:
+              return True, (cmd, *args)
+            truncate(lpath, 0)   # received data are wrong: don't resume from them
+            result = {'code': -1, 'error': 'ChecksumMismatchError', 'path': lpath,
+                      'description': 'sha256 of received data is %s instead of %s' %
+                                     (digest.hexdigest(), sha)}
+          elif prefetched and r.status_code in self.EXPIRED:
+            return self._task(cmd, args[0], lpath, resume=resume, size=size,   # with the new link
+                              sha256=sha)
+          else:
+            # prepare error description for secondary request
+            result = r.json() if r.text else dict()
+            result['code'] = r.status_code
+        except requests.RequestException as e:   # it is OSError too: handle it first
+          result = self._exception(e)
         except OSError as e:
-          # prepare error description for failed file/socket operation
+          # prepare error description for failed file operation
           result = {'code': -1, 'error': 'OSError', 'path': lpath,
                     'errno': e.errno, 'description': e.strerror}
-        if r.status_code == 200:
-          return True, (cmd, *args)
-        # prepare error description for secondary request
-        status = r.status_code
-        result = r.json() if r.text else dict()
         # do not return here, handle error in section below
 
-      # List
-      elif cmd == 'list':
-        items = result['items']
-        result = []
-        for i in items:
-          item = {key: i[key] for key in ['path', 'type', 'modified', 'sha256', 'size']}
-          item['path'] = item['path'][6:]  #.replace('disk:/', '')
-          item['custom_properties'] = item.get('custom_properties')
-          result.append(item)
-        return True, result
-
-      # Info
-      elif cmd in 'info':
-        return True, result
-
-      # Last 10
-      elif cmd == 'last':
-        return True, [item['path'][6:] for item in result['items']]  #.replace('disk:/', '')
-
-      # get file/path properties
-      elif cmd == 'res':
-        result['path'] = result['path'][6:]  #.replace('disk:/', '')
-        result['custom_properties'] = result.get('custom_properties')
-        return True, result
+      # 'list', 'info', 'last' and 'res'
+      else:
+        return True, self._format(cmd, result, self._records)
 
     # Handle errors
+    return self._done(cmd, args, False, result)
+
+  def _single(self, key, func):
+    ''' Perform func() only once for simultaneous calls with the same key: the first caller
+        makes the request, others wait for it and receive the copy of its result.
+    '''
+    with self._flight_lock:
+      ft = self._flight.get(key)
+      first = ft is None
+      if first:
+        ft = self._flight[key] = Future()
+    if not first:
+      status, result = ft.result()
+      return status, dict(result) if isinstance(result, dict) else result
+    try:
+      status, result = res = func()
+      ft.set_result((status, dict(result) if isinstance(result, dict) else result))
+      return res
+    except BaseException as e:
+      ft.set_exception(e)
+      raise
+    finally:
+      with self._flight_lock:
+        del self._flight[key]
+
+  def _many(self, paths):
+    ''' request properties of paths concurrently (not more than bulk_threads at once)'''
+    fts = {path: self._bulk.submit(Cloud.task, self, 'res', path) for path in paths}
+    return {path: ft.result() for path, ft in fts.items()}
+
+  @staticmethod
+  def _format(cmd, result, records=False):
+    ''' make the result of successful information request'''
+    # List
+    if cmd == 'list':
+      # the request projects items to the required fields only, so decoded items are reused
+      if records:
+        return [_Item(i['path'][6:], i['type'], i['modified'], i.get('sha256'), i.get('size'),
+                      i.get('custom_properties')) for i in result['items']]
+      items = result['items']
+      for item in items:
+        item['path'] = item['path'][6:]  #.replace('disk:/', '')
+        item['custom_properties'] = item.get('custom_properties')
+      return items
+
+    # Last 10
+    elif cmd == 'last':
+      return [item['path'][6:] for item in result['items']]  #.replace('disk:/', '')
+
+    # get file/path properties
+    elif cmd == 'res':
+      result['path'] = result['path'][6:]  #.replace('disk:/', '')
+      result['custom_properties'] = result.get('custom_properties')
+
+    # Info
+    return result
+
+  @staticmethod
+  def _done(cmd, args, status, result):
+    ''' make the final result of simple operation'''
+    if status:
+      return status, (cmd, *args)
     error('%s(%s) returned %s' % (cmd, ', '.join(str(i) for i in args), str(result)))
     return False, (cmd, *args, result)
@@ -17,13 +17,15 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from os import stat as file_info, chmod
+from os import stat as file_info, chmod, remove, makedirs, listdir
 from os.path import join as path_join, relpath, exists as pathExists
 from Cloud import Cloud as _Cloud
 from jconfig import Config
-from tempfile import NamedTemporaryFile as tempFile
+from hashlib import sha1, sha256
+from concurrent.futures import Future
 from shutil import move as fileMove
 from datetime import datetime
+from threading import Lock
 from logging import debug, info, warning, error, critical
 
 class Cloud(_Cloud):
@@ -31,17 +33,29 @@ class Cloud(_Cloud):
     Redefined cloud class for implement application level logic
     - all paths in parameters are absolute paths only
     - download/upload have only 1 parameter - absolute path of file
-    - getList converted to generator that yields individual file
+    - getList converted to generator that yields individual file as soon as it is received
+      (page size is 'list_chunk' config value, default: 1000, 'list_window' pages are
+      requested at once). When 'list_mode' config value is 'tree' then it yields all files and
+      folders (including empty ones) walking the folders tree (see 'tree' command)
     - modified property converted to POSIX time value
-    - download is performed through the temporary file
+    - download is performed through the partial file that is kept for resume of failed download
+      (it is removed when the cloud file is deleted: when its properties are not found on the next
+      download or when it is not in the complete listing)
+    - downloaded data are hashed as they arrive and checked against the cloud sha256 before the
+      partial file is moved into place
+    - sha256 of local files are kept in the hash record (work_dir/hash.data) and they are reused
+      while size and modification time of file are the same (see _hash)
     - upload stores access mode of file in custom_properties
     - download restores access mode from custom_properties of file
     - additional methods to store and get/apply the access mode of the file.
     - history data updates according to the success operations
+    - upload is skipped when the cloud file has the same content (sha256 and size)
+    - upload is replaced by the cloud copy when other cloud file has the same content
 
     The task method can be called with following parameters:
     'list' - returns generator that yields all cloud files individually
     'prop', path - returns path properties
+    'res_many', paths - returns dict {path: (status, properties)} for many paths
     'getm', path - returns cloud file access mode (previously stored)
     'setm', path - stores local access mode to cloud
     'down', path - downloads corresponding cloud file to local path
@@ -49,13 +63,21 @@ class Cloud(_Cloud):
       and with other commands of original cloud class but all paths are full local paths.
   '''
 
-  def __init__(self, token, path, work_dir):
+  def __init__(self, token, path, work_dir, config=None):
     self.h_data = Config(path_join(work_dir, 'hist.data'))  # History data {path: lastModifiedDateTime}
+    self.hashes = Config(path_join(work_dir, 'hash.data'))  # {path: [sha256 hex, size, mtime_ns]}
+    self.c_data = dict()  # known content of cloud files {path: (sha256 digest, size)}
+    self.c_index = dict()  # index of cloud files content {sha256 digest: path}
+    self.c_mode = dict()  # known access mode stored in cloud files properties {path: mode}
     self.path = path
     self.work_dir = work_dir
-    super().__init__(token)
+    makedirs(path_join(work_dir, 'partial'), exist_ok=True)  # folder for partial downloads
+    self._active = set()  # partial files of downloads in progress
+    self._active_lock = Lock()
+    super().__init__(token, config)
     self.FUNC = { 'list' : self._getList,
                   'res'  : self._getResource,
+                  'res_many': self._getResources,
                   'mkdir': self._mkDir,
                   'del'  : self._delete,
                   'move' : self._move,
@@ -68,105 +90,329 @@ class Cloud(_Cloud):
     func = self.FUNC.get(cmd)
     return super().task(cmd, *args, **kwargs) if func is None else func(cmd, *args, **kwargs)
 
+  def prefetch(self, cmd, path):
+    ''' The upload link is not requested when the upload is going to be skipped or replaced by
+        the cloud copy: the file is not changed since it was hashed and its content is known.
+    '''
+    if cmd == 'up':
+      try:
+        local = self._hashed(path, file_info(path))
+      except OSError:
+        return  # upload will fail
+      if local is not None and (self.c_data.get(path) == local or
+                                local[1] >= self.config.get('dedup_min', 1 << 20) and
+                                self.c_index.get(local[0], path) != path):
+        return
+    super().prefetch(cmd, relpath(path, start=self.path))
+
   def _reformat(self, item):
-    item['path'] = path_join(self.path, item['path'])
-    item['modified'] = int(datetime.strptime(item['modified'].replace(':', ''),
-                                             '%Y-%m-%dT%H%M%S%z').timestamp())
+    path = path_join(self.path, item['path'])
+    modified = int(datetime.strptime(item['modified'].replace(':', ''),
+                                     '%Y-%m-%dT%H%M%S%z').timestamp())
+    if isinstance(item, dict):
+      item['path'], item['modified'] = path, modified
+      return item
+    return item._replace(path=path, modified=modified)  # compact record of 'list'
+
+  def _remember(self, path, item):
+    ''' store the content identity and the stored access mode of the cloud file'''
+    if item.get('type') == 'file' and item.get('sha256'):
+      self.c_mode[path] = (item.get('custom_properties') or dict()).get('mode')
+      return self._store(path, (bytes.fromhex(item['sha256']), item['size']))
+
+  def _store(self, path, known):
+    self.c_data[path] = known
+    self.c_index[known[0]] = path
+    return known
+
+  def _forget(self, path):
+    ''' remove known content of path and all paths within it'''
+    for p in [p for p in list(self.c_data) if p == path or p.startswith(path + '/')]:
+      known = self.c_data.pop(p, None)
+      self.c_mode.pop(p, None)
+      if known is not None and self.c_index.get(known[0]) == p:
+        self.c_index.pop(known[0], None)
+
+  def _hash(self, path):
+    ''' returns tuple (sha256 digest, size) of local file. The file is read only when it is
+        changed since its digest was stored to the hash record.
+    '''
+    fst = file_info(path)
+    known = self._hashed(path, fst)
+    if known is not None:
+      return known
+    h = sha256()
+    size = 0
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        h.update(chunk)
+        size += len(chunk)
+    self._record(path, h.digest(), fst)   # file changed while reading won't match this record
+    return h.digest(), size
+
+  def _hashed(self, path, fst):
+    ''' returns (sha256 digest, size) from the hash record or None when file (os.stat result fst)
+        is changed since its digest was stored
+    '''
+    rec = self.hashes.get(path)
+    if rec is not None and rec[1:] == [fst.st_size, fst.st_mtime_ns]:
+      return bytes.fromhex(rec[0]), rec[1]
+    return None
+
+  def _record(self, path, digest, fst):
+    ''' store sha256 digest of local file with its size and modification time (os.stat result)'''
+    self.hashes[path] = [digest.hex(), fst.st_size, fst.st_mtime_ns]
 
   def _getList(self, cmd, chunk=None):  # getList is a generator that yields individual file
-    offset = 0
-    chunk = chunk or 30
-    while True:
-      status, result = super().task(cmd, chunk, offset)
-      if status:
-        l = len(result)
-        if l:
-          for i in result:
-            self._reformat(i)
-            yield True, i
-          if l < chunk:
-            break
-          else:
-            offset += chunk
-        else:
-          break
-      else:
-        break
+    chunk = chunk or self.config.get('list_chunk', 1000)
+    if self.config.get('list_mode') == 'tree':
+      # folders (including empty ones) are walked concurrently ('tree' of original cloud class)
+      status, result = super().task('tree', '/', chunk)
+    else:
+      # several pages are requested at once (see 'files' command of original cloud class)
+      status, result = super().task('files', chunk)
+    listed = set()  # cloud files paths for the check of known content and partial downloads
+    for status, i in result:
+      if not status:
+        return
+      i = self._reformat(i)
+      self._remember(i['path'], i)
+      listed.add(i['path'])
+      yield True, i
+    self._prune(listed)
+    self._sweep(listed)
+
+  def _prune(self, listed):
+    ''' forget known content of cloud files that are not among listed cloud files'''
+    for p in [p for p in list(self.c_data) if p not in listed]:
+      self._forget(p)
+
+  def _partial(self, r_path):
+    ''' returns the path of partial file of download of the cloud file r_path'''
+    return path_join(self.work_dir, 'partial', sha1(r_path.encode()).hexdigest())
+
+  def _drop(self, temp):
+    ''' remove the partial file and its sidecar'''
+    for p in (temp, temp + '.info'):
+      try:
+        remove(p)
+      except OSError:
+        pass
+
+  def _sweep(self, listed):
+    ''' remove partial downloads of files that are not among listed cloud files'''
+    folder = path_join(self.work_dir, 'partial')
+    names = set(listdir(folder))
+    for name in {n[:-5] if n.endswith('.info') else n for n in names}:
+      temp = path_join(folder, name)
+      with self._active_lock:
+        if temp in self._active:
+          continue  # the download is in progress: its data file can be not created yet
+      side = Config(temp + '.info', load=name + '.info' in names)
+      if (name not in names or not side.loaded or
+          path_join(self.path, side.get('path', '')) not in listed):
+        info('partial download of %s is removed' % side.get('path', name))
+        self._drop(temp)
 
   def _getResource(self, cmd, path):
     status, result = super().task(cmd, relpath(path, start=self.path))
     if status:
       self._reformat(result)
+      self._remember(path, result)
     return status, result
 
+  def _getResources(self, cmd, paths):
+    r_paths = {relpath(path, start=self.path): path for path in paths}
+    status, result = super().task(cmd, r_paths)
+    for r_path, (st, res) in result.items():
+      if st:
+        path = r_paths[r_path]
+        self._reformat(res)
+        self._remember(path, res)
+    return status, {r_paths[r_path]: res for r_path, res in result.items()}
+
   def _getMode(self, cmd, path):
     r_path = relpath(path, start=self.path)
     st, f_res = super().task('res', r_path)
-    if st:
-      props = f_res.get("custom_properties")
-      if props is not None:
-        mode = props.get("mode")
-        if mode is not None:
-          chmod(path, mode)
-        return True, ('getm', r_path)
+    if st and self._applyMode(path, f_res):
+      return True, ('getm', r_path)
     return False, ('getm', r_path, dict())
 
+  def _applyMode(self, path, res):
+    props = res.get("custom_properties")
+    if props is not None:
+      mode = props.get("mode")
+      if mode is not None:
+        chmod(path, mode)
+      return True
+    return False
+
   def _setMode(self, cmd, path):
-    st, res = self._r_setMode(relpath(path, start=self.path), file_info(path).st_mode)
+    st, res = self._r_setMode(path, file_info(path).st_mode)
     if st:
       res = ('setm', res[1])
     return st, res
 
-  def _r_setMode(self, r_path, mode):
-    return super().task('prop', r_path, mode=mode)
+  def _r_setMode(self, path, mode):
+    st, res = super().task('prop', relpath(path, start=self.path), mode=mode)
+    if st:
+      self.c_mode[path] = mode
+    return st, res
 
-  def _download(self, cmd, path):    # download via temporary file to make it in transaction manner
-    with tempFile(suffix='.temp', delete=False) as f:  # , dir=self.work_dir
-      temp = f.name
+  def _download(self, cmd, path):
+    ''' Download is performed via partial file in the work_dir/partial folder to make it in
+        transaction manner. The partial file is kept when download fails. The sidecar file
+        (<partial file>.info) stores the cloud path, size, modified and sha256 of downloading
+        file. When these values are the same as the current cloud values then the next download
+        of this file continues from the last received byte.
+    '''
     r_path = relpath(path, start=self.path)
-    status, res = super().task(cmd, r_path, temp)
+    status, res = super().task('res', r_path)
+    temp = self._partial(r_path)
+    if not status:
+      self._release(cmd, r_path)
+      if res[-1].get('code') == 404 and pathExists(temp):
+        self._drop(temp)  # the cloud file is deleted: its partial download is useless now
+      return status, (cmd, *res[1:])
+    with self._active_lock:
+      self._active.add(temp)
+    try:
+      source = {key: res.get(key) for key in ('size', 'modified', 'sha256')}
+      source['path'] = r_path
+      side = Config(temp + '.info', load=pathExists(temp))
+      resume = side.loaded and side == source and pathExists(temp)
+      if not resume:
+        side.erase()
+        side.append(source)
+        side.save()
+      status, result = super().task(cmd, r_path, temp, resume=resume, size=res.get('size'),
+                                    sha256=res.get('sha256'))
+    finally:
+      with self._active_lock:
+        self._active.discard(temp)
     if status:
       try:
         fileMove(temp, path)
-        self.h_data[path] = int(file_info(path).st_mtime)
-        self._getMode('', path)
+        self._drop(temp)  # only the sidecar is left after the move
+        self._remember(path, res)
+        fst = file_info(path)
+        self.h_data[path] = int(fst.st_mtime)
+        if res.get('sha256'):
+          self._record(path, bytes.fromhex(res['sha256']), fst)  # verified while downloading
+        self._applyMode(path, res)
       except OSError as e:
         status = False
-        res = {'code': -1, 'error': 'OSError', 'path': path,
-               'errno': e.errno, 'description': e.strerror}
-    return status, res
+        result = {'code': -1, 'error': 'OSError', 'path': path,
+                  'errno': e.errno, 'description': e.strerror}
+    return status, result
 
   def _upload(self, cmd, path):
+    ''' Upload is skipped when the cloud file has the same sha256 and size as the local file.
+        The cloud file content is taken from the last listing or (for the file that was synced
+        before) it is requested by 'res'. In this case only history is updated and the mode is
+        stored when it differs from the mode known for the cloud file.
+        The content of the cloud file that is not in the complete listing is forgotten, and the
+        file is uploaded when storing of the mode finds that the cloud file is deleted.
+        The file bigger than dedup_min (config value, default: 1 MB) is copied in the cloud
+        when other cloud file with the same content is known.
+    '''
     r_path = relpath(path, start=self.path)
-    status, res = super().task(cmd, r_path, path)
+    try:
+      local = self._hash(path)
+    except OSError:
+      local = None  # let the upload to report an error
+    if local is not None:
+      cloud = self.c_data.get(path)
+      if cloud is None and path in self.h_data:
+        st, res = super().task('res', r_path)
+        if st:
+          cloud = self._remember(path, res)
+      if cloud == local:
+        fst = file_info(path)
+        st, res = True, None
+        if self.c_mode.get(path) != fst.st_mode:
+          st, res = self._r_setMode(path, fst.st_mode)
+        if st:
+          info('up %s: skipped as cloud file has the same content' % r_path)
+          self._release(cmd, r_path)
+          self.h_data[path] = int(fst.st_mtime)
+          return True, (cmd, r_path)
+        if res[-1].get('code') != 404:
+          self._release(cmd, r_path)
+          return False, (cmd, r_path, res[-1])
+        self._forget(path)   # the cloud file is deleted by other client: upload it
+      if local[1] >= self.config.get('dedup_min', 1 << 20) and self._copy(path, r_path, local):
+        self._release(cmd, r_path)
+        status, res = True, (cmd, r_path)
+      else:
+        status, res = super().task(cmd, r_path, path)
+    else:
+      status, res = super().task(cmd, r_path, path)
     if status and pathExists(path):
       fst = file_info(path)
       self.h_data[path] = int(fst.st_mtime)
-      self._r_setMode(r_path, fst.st_mode)
+      self._r_setMode(path, fst.st_mode)
+      if local is not None:
+        self._store(path, local)
     return status, res
 
-  def _delete(self, cmd, path):
-    status, res = super().task(cmd, relpath(path, start=self.path))
+  def _copy(self, path, r_path, local):
+    ''' Make the cloud copy of other cloud file with the same content instead of upload.
+        The content of the copy is checked as the source can be changed by other client.
+        Returns True on success.
+    '''
+    src = self.c_index.get(local[0])
+    if src is None or src == path or self.c_data.get(src) != local:
+      return False
+    # the target can be the cloud file that is replaced by this upload
+    res = super().task('copy', r_path, relpath(src, start=self.path), overwrite=True)
+    if isinstance(res, Future):
+      res = res.result()  # copy of file is rather fast operation even if it is asynchronous
+    status = res[0]
     if status:
-      # remove all subdirectories and files in the path if path is a directory or
-      # remove just the path if it is a file
-      to_remove = [p for p in iter(self.h_data) if p.startswith(path)]
-      for p in to_remove:
-        self.h_data.pop(p, None)
-    return status, res
+      status, res = super().task('res', r_path)
+      status = status and self._remember(path, res) == local
+    if status:
+      info('up %s: copied in cloud from %s' % (r_path, src))
+    return status
+
+  def _delete(self, cmd, path):
+    def done(status, res):
+      if status:
+        # remove all subdirectories and files in the path if path is a directory or
+        # remove just the path if it is a file
+        to_remove = [p for p in iter(self.h_data) if p.startswith(path)]
+        for p in to_remove:
+          self.h_data.pop(p, None)
+        for p in [p for p in list(self.hashes) if p == path or p.startswith(path + '/')]:
+          del self.hashes[p]
+        self._forget(path)
+      return status, res
+
+    return self._then(super().task(cmd, relpath(path, start=self.path)), done)
 
   def _move(self, cmd, pathto, pathfrom):
-    status, res = super().task(cmd, relpath(pathto, start=self.path),
-                               relpath(pathfrom, start=self.path))
-    if status:
-      # update history date too
-      p = self.h_data.pop(pathfrom, None)
-      if p is not None:
-        self.h_data[pathto] = p
-      else:
-        if pathExists(pathto):
-          self.h_data[pathto] = int(file_info(pathto).st_mtime)
-    return status, res
+    def done(status, res):
+      if status:
+        # update history date too
+        p = self.h_data.pop(pathfrom, None)
+        if p is not None:
+          self.h_data[pathto] = p
+        else:
+          if pathExists(pathto):
+            self.h_data[pathto] = int(file_info(pathto).st_mtime)
+        # local digests and known content move with the file or with all files within the folder
+        for p in [p for p in list(self.hashes) if p == pathfrom or p.startswith(pathfrom + '/')]:
+          self.hashes[pathto + p[len(pathfrom):]] = self.hashes.pop(p)
+        for p in [p for p in list(self.c_data) if p == pathfrom or p.startswith(pathfrom + '/')]:
+          known = self.c_data.pop(p, None)
+          if known is not None:
+            self._store(pathto + p[len(pathfrom):], known)
+            self.c_mode[pathto + p[len(pathfrom):]] = self.c_mode.pop(p, None)
+      return status, res
+
+    return self._then(super().task(cmd, relpath(pathto, start=self.path),
+                                   relpath(pathfrom, start=self.path)), done)
 
   def _mkDir(self, cmd, path):
     status, res = super().task(cmd, relpath(path, start=self.path))
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+#
+#  CloudTrace - record and replay of HTTP sessions of Cloud
+#
+#  Copyright 2017 Sly_tom_cat <slytomcat@mail.ru>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+from io import BytesIO, RawIOBase
+from json import dumps, loads
+from gzip import open as gzip_open
+from threading import Lock
+from time import time, sleep
+from collections import deque
+from atexit import register as atexit
+from logging import warning
+
+HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'Retry-After',
+           'Location')   # response headers that are stored in trace
+
+def _open(path, mode):
+  ''' trace file is compressed when its name ends with .gz'''
+  return gzip_open(path, mode + 't') if path.endswith('.gz') else open(path, mode + 't')
+
+class Recorder(object):
+  '''
+    Writer of trace file. Each request is stored as one line of JSON:
+      {"at": <start of request since start of recording>, "sec": <duration of request>,
+       "method": ..., "url": ..., "status": ..., "headers": {...}, "body": <response text>,
+       "size": <size of body>} or {..., "error": <exception class name>} for failed request.
+    Authorization header is not stored. The body is stored only for API responses (not for
+    transferred data).
+  '''
+  def __init__(self, path):
+    self._file = _open(path, 'w')
+    self._lock = Lock()
+    self._start = time()
+    atexit(self.close)
+
+  def write(self, request, start, response=None, body=None, exc=None):
+    rec = {'at': round(start - self._start, 4), 'sec': round(time() - start, 4),
+           'method': request.method, 'url': request.url}
+    if exc is not None:
+      rec['error'] = exc.__class__.__name__
+    else:
+      rec['status'] = response.status_code
+      rec['headers'] = {k: response.headers[k] for k in HEADERS if k in response.headers}
+      if body is not None:
+        rec['body'] = body.decode('utf-8', 'replace')
+        rec['size'] = len(body)
+      else:
+        rec['size'] = int(response.headers.get('Content-Length') or 0)
+    line = dumps(rec, separators=(',', ':')) + '\n'
+    with self._lock:
+      self._file.write(line)
+      self._file.flush()
+
+  def close(self):
+    with self._lock:
+      if not self._file.closed:
+        self._file.close()
+
+class RecordAdapter(HTTPAdapter):
+  '''
+    Transport adapter that performs requests as usual and writes them to the recorder. When
+    data is True then the body of successful response is not read (it is the data transfer).
+  '''
+  def __init__(self, recorder, data=False, **kwargs):
+    super().__init__(**kwargs)
+    self._recorder = recorder
+    self._data = data
+
+  def send(self, request, **kwargs):
+    start = time()
+    try:
+      r = super().send(request, **kwargs)
+    except requests.RequestException as e:
+      self._recorder.write(request, start, exc=e)
+      raise
+    data = self._data and r.status_code < 300
+    self._recorder.write(request, start, r, None if data else r.content)
+    return r
+
+class _Zeros(RawIOBase):
+  ''' stream of size zero bytes: replacement of transferred data'''
+  def __init__(self, size):
+    self._left = size
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    n = min(len(b), self._left)
+    b[:n] = bytes(n)
+    self._left -= n
+    return n
+
+class Player(object):
+  '''
+    Reader of trace file. Recorded responses are kept in queues by request (method and URL) and
+    they are returned in the order of recording. The last response of request is repeated when
+    its queue is exhausted.
+  '''
+  def __init__(self, path, scale=1.0):
+    self.scale = scale      # multiplier of recorded latencies (0 - without delays)
+    self.missed = 0         # number of requests that are not in the trace
+    self._lock = Lock()
+    self._queues = dict()   # {(method, url): deque of records}
+    with _open(path, 'r') as f:
+      try:
+        for line in f:
+          if line.endswith('\n'):
+            rec = loads(line)
+            self._queues.setdefault((rec['method'], rec['url']), deque()).append(rec)
+      except EOFError:
+        pass   # trace of interrupted recording: all flushed records are read
+
+  def take(self, method, url):
+    with self._lock:
+      queue = self._queues.get((method, url))
+      if not queue:
+        self.missed += 1
+        return None
+      return queue.popleft() if len(queue) > 1 else queue[0]
+
+class ReplayAdapter(HTTPAdapter):
+  '''
+    Transport adapter that doesn't make network requests: the responses are taken from the trace
+    and returned after the recorded (scaled) delay. The request that is not in the trace
+    receives 404 response with 'ReplayMissingError'. Transferred data are replaced by zeros.
+  '''
+  def __init__(self, player, **kwargs):
+    super().__init__(**kwargs)
+    self._player = player
+
+  def send(self, request, **kwargs):
+    rec = self._player.take(request.method, request.url)
+    if rec is None:
+      warning('replay: %s %s is not in the trace' % (request.method, request.url))
+      rec = {'sec': 0, 'status': 404, 'headers': {'Content-Type': 'application/json'},
+             'body': dumps({'error': 'ReplayMissingError', 'description': request.url})}
+    if rec['sec'] and self._player.scale:
+      sleep(rec['sec'] * self._player.scale)
+    if 'error' in rec:
+      exc = getattr(requests.exceptions, rec['error'], None)
+      if not (isinstance(exc, type) and issubclass(exc, requests.RequestException)):
+        exc = requests.ConnectionError
+      raise exc('replayed %s' % rec['error'], request=request)
+    headers = dict(rec['headers'])
+    if 'body' in rec:
+      body = rec['body'].encode()
+      stream = BytesIO(body)
+      headers['Content-Length'] = str(len(body))
+    else:
+      stream = _Zeros(rec['size'])
+    raw = HTTPResponse(body=stream, headers=headers, status=rec['status'],
+                       preload_content=False, decode_content=False)
+    return self.build_response(request, raw)
+
+if __name__ == '__main__':
+  # print the summary of trace: number of requests, average and maximal latency by endpoints
+  from sys import argv
+  from urllib.parse import urlsplit
+  stat = dict()
+  for queue in Player(argv[1])._queues.values():
+    for rec in queue:
+      url = urlsplit(rec['url'])
+      key = '%s %s' % (rec['method'], url.path if 'body' in rec or 'error' in rec else url.netloc)
+      s = stat.setdefault(key, [0, 0.0, 0.0, 0])
+      s[0] += 1
+      s[1] += rec['sec']
+      s[2] = max(s[2], rec['sec'])
+      s[3] += rec.get('size', 0)
+  for key, (n, total, top, size) in sorted(stat.items()):
+    print('%-50s %6d req avg %.3f max %.3f sec %d bytes' % (key, n, total / n, top, size))
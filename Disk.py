@@ -24,8 +24,8 @@ from pyinotify import ProcessEvent, WatchManager, Notifier, ThreadedNotifier, Ex
 from threading import Thread
 from queue import Queue, Empty
 from PoolExecutor import ThreadPoolExecutor
+from concurrent.futures import Future
 from CloudDisk import Cloud
-from hashlib import sha256
 from shutil import move as fileMove
 from datetime import datetime
 from time import time
@@ -49,7 +49,9 @@ class Disk(Cloud):
       - busy - when some activities are currently performed
       - idle - no activities are currently performed
       - none - not connected
-      - no_net - network connection is not available (try to reconnect it later)
+      - no_net - network connection is not available (try to reconnect it later). When the
+                 network is lost during synchronization the cloud operations are parked and they
+                 continue (and status returns back) when it is available again.
       - error - some error (inspect the errorReason and try to fix it)
      All working paths within this class are absolute paths.
   '''
@@ -77,8 +79,9 @@ class Disk(Cloud):
       self.errorReason = "Can't access the local folder %s" % dataFolderPath
       critical(self.errorReason)
     else:
-      super().__init__(self.user['auth'], path, dataFolderPath)
-      self.executor = ThreadPoolExecutor()
+      super().__init__(self.user['auth'], path, dataFolderPath, self.user)
+      self.executor = ThreadPoolExecutor(self.workers)  # the same number of threads as in pools
+      self.blocking = False   # don't wait for asynchronous cloud operations in working threads
       self.downloads = set()  # set of currently downloading files
       # event handler thread
       self.EH = Thread(target=self._eventHandler)
@@ -160,6 +163,7 @@ class Disk(Cloud):
         stime = time()
       if status == 'idle':
         self.h_data.save()
+        self.hashes.save()
         if self.error:
           info('Some errors was detected during sync --> fillSync required')
           self.error = False
@@ -221,7 +225,11 @@ class Disk(Cloud):
 
     def taskCB(ft):
       res = ft.result()
-      unf = self.executor.unfinished()
+      if isinstance(res, Future):
+        # asynchronous cloud operation is still in progress: handle it when poller finishes it
+        res.add_done_callback(taskCB)
+        return
+      unf = self.executor.unfinished() + self.pending()
       info('Done: %s, %d unfinished' % (str(res), unf))
       if isinstance(res, tuple):
         stat, rets = res      # it is cloud operation
@@ -234,14 +242,17 @@ class Disk(Cloud):
       #  <do something after full sync>
       if unf == 0:  # all done
         self.downloads = set()  # clear downloads as no more downloads required
-        self._setStatus('idle')
+        if self.status != 'no_net':   # status is restored when network is available
+          self._setStatus('idle')
 
     if isinstance(task, str):
+      if task in ('up', 'down'):
+        self.prefetch(task, args[0])  # request the transfer link while previous tasks are running
       ft = self.executor.submit(self.task, task, *args, **kwargs)
     else:
       ft = self.executor.submit(task, *args, **kwargs)
     ft.add_done_callback(taskCB)
-    if self.status != 'busy':
+    if self.status not in ('busy', 'no_net'):
       self._setStatus('busy')
     info('submit %s %s' % (str(task) , str(args)))
 
@@ -266,9 +277,9 @@ class Disk(Cloud):
       # ({cloud} & {local}) and hashes are equal = ignore
       # ({cloud} & {local}) and hashes not equal -> decide conflict/upload/download depending on
       # the update time of files and time stored in the history
-      for status, i in self.task('list', 40):
+      for status, i in self.task('list'):
         if status:
-          path = i['path']         # full file path !NOTE! getList doesn't return empty folders
+          path = i['path']         # full path !NOTE! folders are listed only in 'tree' list_mode
           p = path_split(path)[0]  # containing folder
           if in_paths(p, exclude):
             continue
@@ -280,16 +291,14 @@ class Disk(Cloud):
               # - restore UGM from cloud
               # but for this decision we need last updated data for directories in history
               ####
-              # !!! Actually Yd don't return empty folders in file list !!!
-              # This section newer run
+              # Folders are listed only in 'tree' list_mode (flat list of files doesn't have them)
               ####
-              #ignore_path_down(path); continue
-              pass
+              ignore_path_down(path)  # add in ignore and history it and all folders by way to it
+              continue
             else:                     # existig file
               try:
-                with open(path, 'rb') as f:
-                  hh = sha256(f.read()).hexdigest()
-              except:
+                hh = self._hash(path)[0].hex()   # it is read only when file is changed
+              except OSError:
                 hh = ''
               c_t = i['modified']                       # cloud file modified date-time
               l_t = int(file_info(path).st_mtime)       # local file modified date-time
@@ -358,9 +367,11 @@ class Disk(Cloud):
               self._submit('del', p)
               # add d to exceptions to avoid unnecessary checks for other files which are within p
               exclude.add(p)
-            else:                   # only file was deleted
+            else:                   # only file (or folder) was deleted
               self._submit('del', path)
               del self.h_data[path]  # remove history
+              if i['type'] == 'dir':
+                exclude.add(path)   # files within deleted folder are deleted with it
           else:   # local file have to be downloaded from the cloud
             if i['type'] == 'file':
               if not pathExists(p):
@@ -370,9 +381,9 @@ class Disk(Cloud):
               self.downloads.add(path)            # store downloaded file in downloads to avoid upload
               self._submit('down', path)
               ignore.add(path)
-            #else:                                 # directory not exists  !!! newer run !!!
-            #  self.downloads.add(ignore_path_down(path))  # store new dir in downloads to avoid upload
-            #  makedirs(path, exist_ok=True)
+            else:                                 # directory not exists (only in 'tree' list_mode)
+              self.downloads |= ignore_path_down(path)  # store new dir in downloads to avoid upload
+              makedirs(path, exist_ok=True)
       # ---- Done forward path (sync cloud to local) ------
       # (local - ignored) -> upload to cloud
       for root, dirs, files in walk(self.path):
@@ -534,8 +545,9 @@ class Disk(Cloud):
   def connect(self):
     '''Activate synchronizations with Yandex.disk
        Check connection and activate local watching object and cloud listener'''
-    if self.status.startswith('no'): # self.status in ('none', 'no_net')
-      if self.task('info')[0]:  # check connection
+    # self.status in ('none', 'no_net') and network is not watched by the cloud (see network)
+    if self.status.startswith('no') and not self.watch.started:
+      if self.probe():  # check connection
         self.watch.start()
         #self.listener.start()
         self._setStatus('busy')
@@ -543,9 +555,18 @@ class Disk(Cloud):
       else:
         self._setStatus('no_net')
 
+  def network(self, online):
+    '''Switch to 'no_net' status when the network is lost during synchronization and back when it
+       is available again (it is called by the cloud). Parked operations continue without fullSync.
+    '''
+    if not online and self.connected():
+      self._setStatus('no_net')
+    elif online and self.status == 'no_net' and self.watch.started:
+      self._setStatus('busy' if self.executor.unfinished() + self.pending() else 'idle')
+
   def disconnect(self):
     '''Deactivate synchronizations with Yandex.disk'''
-    if self.connected():
+    if self.connected() or self.status == 'no_net':
       self.watch.stop()
       #self.listener.stop()
       self._setStatus('none')
@@ -555,13 +576,13 @@ class Disk(Cloud):
       self._submit('trash')
 
   def exit(self):
-    if self.connected():
-      self.disconnect()
+    self.disconnect()
     self.shutdown = True
     if self.status != 'fault':
       self.watch.exit()
       self.watch.put(None)
       self.EH.join()
+      self.release()  # don't wait for the network: parked operations fail at once
       self.executor.shutdown(wait=True)
     self._setStatus('exit')
     self.SU.join()
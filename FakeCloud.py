@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+#
+#  FakeCloud - local stand-in of yandex.disk REST API for offline tests and benchmarks
+#
+#  Copyright 2017 Sly_tom_cat <slytomcat@mail.ru>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+from socket import SHUT_RDWR
+from threading import Thread, Lock
+from hashlib import sha256, md5
+from json import dumps, loads
+from random import Random
+from time import time, sleep, strftime, gmtime
+from itertools import count
+from re import fullmatch
+
+def _now():
+  return strftime('%Y-%m-%dT%H:%M:%S+00:00', gmtime())
+
+def _norm(path):
+  ''' convert the path parameter of request to the form '/a/b' ('/' for the root)'''
+  if path.startswith('disk:'):
+    path = path[5:]
+  return '/' + path.strip('/')
+
+def _parent(path):
+  return path.rsplit('/', 1)[0] or '/'
+
+def _inside(path, root):
+  return path == root or path.startswith(root.rstrip('/') + '/')
+
+def _project(obj, fields):
+  ''' leave in obj only the fields (list of dotted keys like 'items.path')'''
+  if not fields or not isinstance(obj, dict):
+    return obj
+  if 'items' in obj and not any(f.partition('.')[0] in obj for f in fields):
+    # like API does: fields of list response that are not in it are applied to its items
+    return dict(obj, items=[_project(i, fields) for i in obj['items']])
+  rests = dict()   # {key: [rest of field, ...]}
+  for field in fields:
+    key, _, rest = field.partition('.')
+    if key in obj:
+      rests.setdefault(key, []).append(rest)
+  res = dict()
+  for key, rest in rests.items():
+    value = obj[key]
+    if all(rest):   # only the parts of value are required
+      value = ([_project(v, rest) for v in value] if isinstance(value, list) else
+               _project(value, rest))
+    res[key] = value
+  return res
+
+class _Error(Exception):
+  ''' error response of API: status code, error identity and description'''
+  def __init__(self, code, error, description=''):
+    super().__init__(code, error, description)
+    self.code = code
+    self.body = {'error': error, 'description': description, 'message': description}
+
+class _Server(ThreadingHTTPServer):
+  request_queue_size = 1024
+  daemon_threads = True
+
+class _Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+
+  def log_message(self, *args):
+    pass
+
+  def do_GET(self):
+    self.server.fake._handle(self, 'GET')
+
+  def do_PUT(self):
+    self.server.fake._handle(self, 'PUT')
+
+  def do_POST(self):
+    self.server.fake._handle(self, 'POST')
+
+  def do_PATCH(self):
+    self.server.fake._handle(self, 'PATCH')
+
+  def do_DELETE(self):
+    self.server.fake._handle(self, 'DELETE')
+
+class FakeCloud(object):
+  '''
+    Local HTTP server that implements the part of yandex.disk REST API that is used by Cloud:
+    disk info, last uploaded files, resource properties (with _embedded list of folder), flat
+    file list, custom properties, mkdir, delete, trash cleaning, move, copy, upload and download
+    links and data transfers via these links (with Range requests). Folder operations and trash
+    cleaning are asynchronous (202 + operation status link) when async_time > 0. Files are kept
+    in memory. The fields parameter of request is applied to the response.
+
+    Usage:
+      fake = FakeCloud(latency=0.02)
+      cloud = Cloud('token', {'baseurl': fake.baseurl})
+      ...
+      fake.stop()
+
+    Parameters:
+      token      - expected value of Authorization header (None - any value is accepted)
+      latency    - delay of each API response in seconds
+      bandwidth  - limit of data transfer speed of one upload/download in bytes per second
+      rate       - limit of API requests per second, excess requests receive 429 with Retry-After
+      async_time - duration of asynchronous operations in seconds (0 - all operations are sync)
+      errors     - probability of random 503 response to API request (seed makes it repeatable)
+      href_ttl   - lifetime of upload/download links in seconds (0 - links never expire)
+
+    Errors can be also injected by fail method. When offline attribute is True all connections
+    are broken at once (like the network is lost). When ranges attribute is False the Range
+    header of downloads is ignored (like some servers do). The number of requests by endpoints
+    is available in requests attribute.
+  '''
+  def __init__(self, token=None, latency=0, bandwidth=0, rate=0, async_time=0, errors=0,
+               href_ttl=0, seed=None, host='127.0.0.1', port=0):
+    self.token = token
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.rate = rate
+    self.async_time = async_time
+    self.errors = errors
+    self.href_ttl = href_ttl
+    self.total_space = 10 << 30
+    self.offline = False
+    self.ranges = True
+    self.requests = dict()       # {endpoint: number of requests}
+    self._random = Random(seed)
+    self._lock = Lock()
+    self._files = dict()         # {path: (data, meta)}
+    self._dirs = {'/': {'created': _now(), 'modified': _now()}}  # {path: meta}
+    self._trash = 0              # size of files in trash
+    self._uploaded = []          # paths of uploaded files (the last is the most recent)
+    self._links = dict()         # {id: (kind, path, expiration time)}
+    self._operations = dict()    # {id: (finish time, status)}
+    self._faults = []            # [[endpoint pattern, count, status, headers]]
+    self._allowance = 0          # tokens of request rate limit
+    self._stamp = time()
+    self._ids = count()
+    self._server = _Server((host, port), _Handler)
+    self._server.fake = self
+    self.url = 'http://%s:%d' % self._server.server_address[:2]
+    self.baseurl = self.url + '/v1/disk'
+    self._thread = Thread(target=self._server.serve_forever)
+    self._thread.name = 'FakeCloud'
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+  # ---- data access for tests --------------------------------------------------------------
+  def put(self, path, data=b''):
+    ''' create or replace file (parent folders are created when it is necessary)'''
+    path = _norm(path)
+    with self._lock:
+      parent = _parent(path)
+      while parent not in self._dirs:
+        self._dirs[parent] = {'created': _now(), 'modified': _now()}
+        parent = _parent(parent)
+      self._store(path, bytes(data))
+
+  def get(self, path):
+    ''' returns the content of file or None'''
+    item = self._files.get(_norm(path))
+    return None if item is None else item[0]
+
+  def exists(self, path):
+    path = _norm(path)
+    return path in self._files or path in self._dirs
+
+  def fail(self, endpoint, n=1, status=503, headers=None):
+    ''' Next n requests to endpoint receive response with status. The endpoint is a regular
+        expression that should match the path of request URL, e.g. '/v1/disk/resources' or
+        '/download/.*'. The status 0 means that the connection is broken in the middle of the
+        response body (or before the response for requests without body). The status -1 means
+        that the connection stalls there: nothing is sent during STALL seconds before the break.
+    '''
+    with self._lock:
+      self._faults.append([endpoint, n, status, headers or dict()])
+
+  # ---- internal data handling -------------------------------------------------------------
+  def _store(self, path, data):
+    meta = self._files.get(path, (None, {'created': _now(), 'custom_properties': None}))[1]
+    meta = dict(meta, modified=_now(), sha256=sha256(data).hexdigest(),
+                md5=md5(data).hexdigest(), resource_id='%d:%s' % (len(path), path))
+    self._files[path] = (data, meta)
+
+  def _meta(self, path):
+    if path in self._files:
+      data, meta = self._files[path]
+      res = {'path': 'disk:' + path, 'type': 'file', 'name': path.rsplit('/', 1)[-1],
+             'size': len(data), 'mime_type': 'application/octet-stream', 'media_type': 'data',
+             'preview': self.url + '/preview' + path, 'revision': 1}
+    else:
+      meta = self._dirs[path]
+      res = {'path': 'disk:' + path, 'type': 'dir', 'name': path.rsplit('/', 1)[-1]}
+    res.update((k, v) for k, v in meta.items() if v is not None or k == 'custom_properties')
+    if res.get('custom_properties') is None:
+      res.pop('custom_properties', None)
+    return res
+
+  def _check_parent(self, path):
+    if _parent(path) not in self._dirs:
+      raise _Error(409, 'DiskPathDoesntExistsError', 'Specified path "%s" does not exist.' %
+                   _parent(path))
+
+  def _source(self, path):
+    if path not in self._files and path not in self._dirs:
+      raise _Error(404, 'DiskNotFoundError', 'Resource not found.')
+
+  def _remove(self, path):
+    ''' remove file or folder with its content, returns size of removed files'''
+    size = 0
+    for p in [p for p in self._files if _inside(p, path)]:
+      size += len(self._files.pop(p)[0])
+    for p in [p for p in self._dirs if _inside(p, path) and p != '/']:
+      del self._dirs[p]
+    return size
+
+  def _transfer(self, dst, src, move):
+    if _inside(dst, src):
+      raise _Error(409, 'DiskCannotMoveOrCopyIntoItselfError', 'Cannot copy into itself.')
+    files = [(p, v) for p, v in self._files.items() if _inside(p, src)]
+    dirs = [(p, v) for p, v in self._dirs.items() if _inside(p, src)]
+    if move:
+      self._remove(src)
+    for p, v in dirs:
+      self._dirs[dst + p[len(src):]] = dict(v)
+    for p, (data, meta) in files:
+      self._files[dst + p[len(src):]] = (data, dict(meta))
+
+  def _operation(self, path, code, body=None):
+    ''' result of operation: asynchronous (for folders) or synchronous'''
+    if self.async_time and (path is None or path in self._dirs):
+      oid = str(next(self._ids))
+      self._operations[oid] = (time() + self.async_time, 'success')
+      return 202, {'href': self.url + '/v1/disk/operations/' + oid, 'method': 'GET',
+                   'templated': False}
+    return code, body
+
+  def _link(self, kind, path):
+    lid = '%d%s' % (next(self._ids), path)
+    self._links[lid] = (kind, path, time() + self.href_ttl if self.href_ttl else 0)
+    return {'href': '%s/%s/%s' % (self.url, kind, lid), 'method': 'PUT' if kind == 'upload'
+            else 'GET', 'templated': False}
+
+  def _target(self, kind, lid):
+    link = self._links.get(lid)
+    if link is None or link[0] != kind:
+      raise _Error(404, 'NotFound')
+    if link[2] and time() > link[2]:
+      raise _Error(410, 'Gone')
+    return link[1]
+
+  # ---- request handling -------------------------------------------------------------------
+  def _limited(self):
+    ''' check request rate limit (token bucket with one second burst)'''
+    now = time()
+    self._allowance = min(self._allowance + (now - self._stamp) * self.rate, self.rate)
+    self._stamp = now
+    if self._allowance < 1:
+      return True
+    self._allowance -= 1
+    return False
+
+  def _fault(self, path):
+    with self._lock:
+      for fault in self._faults:
+        if fullmatch(fault[0], path):
+          fault[1] -= 1
+          if fault[1] <= 0:
+            self._faults.remove(fault)
+          return fault[2], fault[3]
+    return None
+
+  def _handle(self, h, method):
+    if self.offline:
+      return self._break(h)
+    url = urlsplit(h.path)
+    path = url.path.rstrip('/') or '/'
+    query = dict(parse_qsl(url.query))
+    api = path.startswith('/v1/disk')
+    endpoint = '%s %s' % (method, path if api else path.split('/', 2)[1])
+    with self._lock:
+      self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+    n = int(h.headers.get('Content-Length') or 0)
+    body = h.rfile.read(n) if n else b''
+    if api and self.latency:
+      sleep(self.latency)
+    fault = self._fault(path)
+    try:
+      if fault is not None and fault[0] > 0:
+        raise _Error(fault[0], 'InjectedError', 'Error is injected by FakeCloud.fail')
+      if fault is not None and not path.startswith('/download/'):
+        return self._break(h, fault[0] < 0)  # status 0/-1: connection is broken before response
+      if api:
+        if self.token is not None and h.headers.get('Authorization') not in (self.token,
+                                                                           'OAuth ' + self.token):
+          raise _Error(401, 'UnauthorizedError', 'Unauthorized')
+        with self._lock:
+          if self.rate and self._limited():
+            return self._send(h, 429, {'error': 'TooManyRequestsError'},
+                              headers={'Retry-After': '%.3f' % (1 / self.rate)})
+        if self.errors and self._random.random() < self.errors:
+          raise _Error(503, 'ServiceUnavailable')
+        with self._lock:
+          code, res = self._api(method, path[8:] or '/', query, body)
+        fields = [f for f in query.get('fields', '').split(',') if f]
+        return self._send(h, code, _project(res, fields))
+      if method == 'PUT' and path.startswith('/upload/'):
+        return self._upload(h, path[8:], body)
+      if method == 'GET' and path.startswith('/download/'):
+        return self._download(h, path[10:], None if fault is None else fault[0])
+      raise _Error(404, 'NotFound')
+    except _Error as e:
+      headers = fault[1] if fault is not None else None
+      return self._send(h, e.code, e.body, headers)
+
+  def _send(self, h, code, obj=None, headers=None, raw=None):
+    body = raw if raw is not None else (dumps(obj).encode() if obj is not None else b'')
+    h.send_response(code)
+    for key, value in (headers or dict()).items():
+      h.send_header(key, value)
+    h.send_header('Content-Type', 'application/json' if raw is None else
+                  'application/octet-stream')
+    h.send_header('Content-Length', str(len(body)))
+    h.end_headers()
+    self._write(h, body)
+
+  def _write(self, h, data):
+    ''' write data to the connection with the bandwidth limit'''
+    view = memoryview(data)
+    chunk = max(self.bandwidth // 20, 1 << 10) if self.bandwidth else len(view) or 1
+    for pos in range(0, len(view), chunk):
+      start = time()
+      h.wfile.write(view[pos:pos + chunk])
+      if self.bandwidth:
+        sleep(max(len(view[pos:pos + chunk]) / self.bandwidth - (time() - start), 0))
+
+  STALL = 60   # duration of stalled connection (see fail)
+
+  def _break(self, h, stall=False):
+    if stall:
+      sleep(self.STALL)
+    h.close_connection = True
+    h.connection.shutdown(SHUT_RDWR)
+
+  def _upload(self, h, lid, body):
+    if self.bandwidth:
+      sleep(len(body) / self.bandwidth)
+    with self._lock:
+      path = self._target('upload', lid)
+      self._check_parent(path)
+      self._store(path, body)
+      self._uploaded.append(path)
+      del self._links[lid]
+    self._send(h, 201)
+
+  def _download(self, h, lid, fault):
+    with self._lock:
+      data = self._files.get(self._target('download', lid), (None,))[0]
+    if data is None:
+      raise _Error(404, 'NotFound')
+    size = len(data)
+    rng = h.headers.get('Range')
+    m = fullmatch(r'bytes=(\d*)-(\d*)', rng or '') if self.ranges else None
+    if m and (m.group(1) or m.group(2)):
+      first = int(m.group(1)) if m.group(1) else max(size - int(m.group(2)), 0)
+      last = min(int(m.group(2)), size - 1) if m.group(1) and m.group(2) else size - 1
+      if first >= size:
+        return self._send(h, 416, raw=b'', headers={'Content-Range': 'bytes */%d' % size})
+      code, data = 206, data[first:last + 1]
+      headers = {'Content-Range': 'bytes %d-%d/%d' % (first, last, size)}
+    else:
+      code, headers = 200, {'Accept-Ranges': 'bytes'}
+    if fault is not None:   # send the half of data and break (or stall) the connection
+      h.send_response(code)
+      for key, value in headers.items():
+        h.send_header(key, value)
+      h.send_header('Content-Length', str(len(data)))
+      h.end_headers()
+      self._write(h, data[:len(data) // 2])
+      h.wfile.flush()
+      return self._break(h, fault < 0)
+    self._send(h, code, raw=data, headers=headers)
+
+  def _api(self, method, path, q, body):
+    ''' perform API request, returns (status code, response object)'''
+    if path.startswith('/operations/') and method == 'GET':
+      op = self._operations.get(path[12:])
+      if op is None:
+        raise _Error(404, 'DiskNotFoundError', 'Operation not found.')
+      return 200, {'status': op[1] if time() >= op[0] else 'in-progress'}
+    if path == '/' and method == 'GET':
+      return 200, {'total_space': self.total_space, 'trash_size': self._trash,
+                   'used_space': sum(len(d) for d, _ in self._files.values()) + self._trash,
+                   'max_file_size': 10 << 30, 'is_paid': False, 'revision': 1}
+    if path == '/trash/resources' and method == 'DELETE':
+      self._trash = 0
+      return self._operation(None, 204)
+    if path == '/resources/last-uploaded' and method == 'GET':
+      limit = int(q.get('limit', 20))
+      paths = []
+      for p in reversed(self._uploaded):
+        if p in self._files and p not in paths:
+          paths.append(p)
+          if len(paths) == limit:
+            break
+      return 200, {'items': [self._meta(p) for p in paths], 'limit': limit}
+    if path == '/resources/files' and method == 'GET':
+      limit, offset = int(q.get('limit', 20)), int(q.get('offset', 0))
+      if not (0 <= limit < 1 << 31 and 0 <= offset < 1 << 31):
+        raise _Error(400, 'FieldValidationError', 'Error validating field "limit".')
+      paths = sorted(self._files)[offset:offset + limit]
+      return 200, {'items': [self._meta(p) for p in paths], 'limit': limit, 'offset': offset}
+    if 'path' not in q:
+      raise _Error(400, 'FieldValidationError', 'Error validating field "path".')
+    target = _norm(q['path'])
+    if path == '/resources':
+      if method == 'GET':
+        self._source(target)
+        res = self._meta(target)
+        if target in self._dirs:
+          limit, offset = int(q.get('limit', 20)), int(q.get('offset', 0))
+          items = sorted(p for p in list(self._dirs) + list(self._files)
+                         if p != target and _parent(p) == target)
+          res['_embedded'] = {'items': [self._meta(p) for p in items[offset:offset + limit]],
+                              'path': 'disk:' + target, 'limit': limit, 'offset': offset,
+                              'total': len(items), 'sort': ''}
+        return 200, res
+      if method == 'PUT':
+        if target in self._dirs:
+          raise _Error(409, 'DiskPathPointsToExistentDirectoryError',
+                       'Specified path "%s" points to existent directory.' % target)
+        self._check_parent(target)
+        if target in self._files:
+          raise _Error(409, 'DiskResourceAlreadyExistsError', 'Resource already exists.')
+        self._dirs[target] = {'created': _now(), 'modified': _now()}
+        return 201, {'href': self.baseurl + '/resources?path=disk:' + target, 'method': 'GET',
+                     'templated': False}
+      if method == 'PATCH':
+        self._source(target)
+        props = loads(body.decode() or '{}').get('custom_properties') or dict()
+        meta = self._files[target][1] if target in self._files else self._dirs[target]
+        merged = dict(meta.get('custom_properties') or dict(), **props)
+        meta['custom_properties'] = {k: v for k, v in merged.items() if v is not None} or None
+        return 200, self._meta(target)
+      if method == 'DELETE':
+        self._source(target)
+        if target == '/':
+          raise _Error(403, 'DiskForbiddenError', 'Forbidden.')
+        res = self._operation(target, 204)
+        size = self._remove(target)
+        if q.get('permanently', 'false') != 'true':
+          self._trash += size
+        return res
+    if path in ('/resources/move', '/resources/copy') and method == 'POST':
+      source = _norm(q.get('from', ''))
+      self._source(source)
+      self._check_parent(target)
+      if target in self._files or target in self._dirs:
+        if q.get('overwrite', 'false') != 'true':
+          raise _Error(409, 'DiskResourceAlreadyExistsError', 'Resource already exists.')
+        self._remove(target)
+      res = self._operation(source, 201, {'href': self.baseurl + '/resources?path=disk:' +
+                                          target, 'method': 'GET', 'templated': False})
+      self._transfer(target, source, path.endswith('move'))
+      return res
+    if path == '/resources/upload' and method == 'GET':
+      self._check_parent(target)
+      if target in self._dirs:
+        raise _Error(409, 'DiskResourceAlreadyExistsError', 'Resource already exists.')
+      if target in self._files and q.get('overwrite', 'false') != 'true':
+        raise _Error(409, 'DiskResourceAlreadyExistsError', 'Resource already exists.')
+      return 200, self._link('upload', target)
+    if path == '/resources/download' and method == 'GET':
+      self._source(target)
+      if target in self._dirs:
+        raise _Error(400, 'NotImplemented', 'Folder download is not supported.')
+      return 200, self._link('download', target)
+    raise _Error(404, 'NotFound', 'Resource not found.')
+
+if __name__ == '__main__':
+  from sys import argv
+  fake = FakeCloud(port=int(argv[1]) if len(argv) > 1 else 8080)
+  print('FakeCloud API is served on %s' % fake.baseurl)
+  try:
+    fake._thread.join()
+  except KeyboardInterrupt:
+    fake.stop()
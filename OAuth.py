@@ -30,6 +30,8 @@ from gi.repository import Gtk
 
 _ = str   # temporary replacement for localization functionality
 
+TIMEOUT = (10, 30)   # timeouts of connection and of waiting for response data (sec)
+
 def getToken(app_id, app_secret, gui=False):
   '''Receive access token via verification code that user can get on authorization page.
 
@@ -68,13 +70,17 @@ def getToken(app_id, app_secret, gui=False):
     else:
       print(msg1, '\n', url, '\n', msg2)
       code = input(msg3)
-    r = requests.post('https://oauth.yandex.ru/token',
-                      {'grant_type': 'authorization_code',
-                       #'device_name': uname().nodename,
-                       'code': code,
-                       'client_id': app_id,
-                       'client_secret': app_secret
-                      })
+    try:
+      r = requests.post('https://oauth.yandex.ru/token',
+                        {'grant_type': 'authorization_code',
+                         #'device_name': uname().nodename,
+                         'code': code,
+                         'client_id': app_id,
+                         'client_secret': app_secret
+                        }, timeout=TIMEOUT)
+    except requests.RequestException as e:
+      print(_('Token request failed: %s') % e)
+      continue
     if r.status_code == 200:
       token = r.json()['access_token']
   return token
@@ -82,8 +88,11 @@ def getToken(app_id, app_secret, gui=False):
 def getLogin(token):
   ''' Receive the user login by token.
   '''
-  r = requests.get('https://webdav.yandex.ru/?userinfo',
-                   headers={'Accept': '*/*', 'Authorization': 'OAuth %s' % token})
+  try:
+    r = requests.get('https://webdav.yandex.ru/?userinfo', timeout=TIMEOUT,
+                     headers={'Accept': '*/*', 'Authorization': 'OAuth %s' % token})
+  except requests.RequestException:
+    return None
   if r.status_code == 200:
     return findall(r'login:(.*)\n', r.text)[0]
   return None
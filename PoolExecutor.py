@@ -42,8 +42,8 @@ def _python_exit():
     global _shutdown
     _shutdown = True
     items = list(_threads_queues.items())
-    if items:
-        items[0][1].put(None)
+    for q in set(q for t, q in items):
+        q.put(None)   # each executor has its own queue
     for t, q in items:
         t.join()
 
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+#
+#  bench-Cloud.py - performance benchmarks of Cloud against the local stand-in server
+#
+#  Copyright 2017 Sly_tom_cat <slytomcat@mail.ru>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from tempfile import TemporaryFile, NamedTemporaryFile
+from requests import Session
+from time import time, sleep, thread_time
+from json import dumps, loads
+from tracemalloc import start as trace_start, stop as trace_stop, get_traced_memory
+from Cloud import Cloud, _Body
+from AsyncCloud import SyncCloud
+from FakeCloud import FakeCloud
+from PoolExecutor import ThreadPoolExecutor
+
+SIZE = 256 << 20  # size of downloaded data
+
+class _Handler(BaseHTTPRequestHandler):
+  ''' serves SIZE bytes of data on any GET request'''
+  protocol_version = 'HTTP/1.1'
+  data = memoryview(bytes(1 << 20))
+
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header('Content-Length', str(SIZE))
+    self.end_headers()
+    for _ in range(SIZE // len(self.data)):
+      self.wfile.write(self.data)
+
+  def log_message(self, *args):
+    pass
+
+class _UpHandler(BaseHTTPRequestHandler):
+  ''' receives and drops the body of any PUT request'''
+  protocol_version = 'HTTP/1.1'
+  buf = memoryview(bytearray(1 << 20))
+
+  def do_PUT(self):
+    size = int(self.headers['Content-Length'])
+    while size:
+      size -= self.rfile.readinto(self.buf[:min(size, len(self.buf))])
+    self.send_response(201)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+UP_SIZE = 1 << 30  # size of uploaded file
+
+def bench_upload(url, cloud):
+  with NamedTemporaryFile() as f:
+    f.truncate(UP_SIZE)
+    # previous implementation: file object is read by urllib3 into bytes blocks
+    with Session() as session:
+      report_upload('up file object', lambda: session.put(url, data=f))
+    # file is sent by sendfile (or via reusable buffer when connection is TLS)
+    report_upload('up _Body', lambda: cloud._up.put(url, data=_Body(f, cloud._buffer())))
+    cloud._up.close()   # test server handles one connection at once
+
+def report_upload(name, put):
+  ''' print time and CPU time of thread (not including the server) per GB of upload'''
+  start, cpu = time(), thread_time()
+  assert put().status_code == 201
+  sec, cpu = time() - start, thread_time() - cpu
+  print('%-24s %8.3f sec %8.1f MB/s %6.3f CPU sec/GB' % (name, sec, UP_SIZE / sec / 1048576,
+                                                        cpu * (1 << 30) / UP_SIZE))
+
+LATENCY = 0.02    # simulated round-trip time of API request
+REQUESTS = 2000   # number of concurrent API requests
+
+def server(handler=_Handler):
+  srv = HTTPServer(('127.0.0.1', 0), handler)
+  t = Thread(target=srv.serve_forever)
+  t.daemon = True
+  t.start()
+  return 'http://127.0.0.1:%d/' % srv.server_address[1]
+
+def report(name, size, sec):
+  print('%-24s %8.3f sec %8.1f MB/s' % (name, sec, size / sec / 1048576))
+
+def bench_download(url, cloud):
+  # previous implementation: iterate over 2 KB chunks
+  with TemporaryFile() as f:
+    start = time()
+    r = cloud._down.get(url, stream=True)
+    for chunk in r.iter_content(2048):
+      f.write(chunk)
+    report('down iter_content(2048)', SIZE, time() - start)
+  # buffered download engine
+  with TemporaryFile() as f:
+    start = time()
+    r = cloud._down.get(url, stream=True)
+    size, sec = cloud._receive(r, f.write)
+    report('down _receive', size, time() - start)
+
+def report_rate(name, n, sec):
+  print('%-24s %8.3f sec %8.1f req/s' % (name, sec, n / sec))
+
+def bench_concurrency(url):
+  # thread per request: Cloud in PoolExecutor with default and with big number of threads
+  for workers in (None, 500):
+    cloud = Cloud('', {'baseurl': url, 'rate_meta': 0, 'workers': workers, 'cache_ttl': 0})
+    executor = ThreadPoolExecutor(cloud.workers)
+    start = time()
+    fts = [executor.submit(cloud.task, 'info') for _ in range(REQUESTS)]
+    assert all(ft.result()[0] for ft in fts)
+    report_rate('info Cloud %d threads' % cloud.workers, REQUESTS, time() - start)
+    executor.shutdown()
+  # one event loop: AsyncCloud via synchronous adapter
+  cloud = SyncCloud('', {'baseurl': url, 'rate_meta': 0, 'connections': 500})
+  start = time()
+  fts = [cloud.submit('info') for _ in range(REQUESTS)]
+  assert all(ft.result()[0] for ft in fts)
+  report_rate('info AsyncCloud', REQUESTS, time() - start)
+  cloud.close()
+
+PAGE = 1000     # number of items in one page of 'list' request
+PAGES = 50      # number of decoded pages
+
+def page(projected, size=PAGE):
+  ''' make the JSON of 'list' page like API returns it with and without fields projection'''
+  items = []
+  for n in range(size):
+    item = {'path': 'disk:/folder/file%06d.jpg' % n, 'type': 'file', 'size': 123456 + n,
+            'modified': '2017-03-01T12:00:00+00:00', 'sha256': '%064x' % n}
+    if not projected:
+      item.update({'name': 'file%06d.jpg' % n, 'created': '2017-03-01T12:00:00+00:00',
+                   'resource_id': '123456789:%064x' % n, 'md5': '%032x' % n,
+                   'mime_type': 'image/jpeg', 'media_type': 'image', 'revision': 1488369600000000,
+                   'antivirus_status': 'clean',
+                   'comment_ids': {'private_resource': '', 'public_resource': ''},
+                   'exif': {'date_time': '2017-03-01T12:00:00+00:00'},
+                   'file': 'https://downloader.disk.yandex.ru/disk/%064x/file%06d.jpg' % (n, n),
+                   'preview': 'https://downloader.disk.yandex.ru/preview/%064x?size=S&crop=0' % n,
+                   'sizes': [{'url': 'https://downloader.disk.yandex.ru/preview/%064x?size=%s' %
+                              (n, s), 'name': s} for s in ('DEFAULT', 'XXXS', 'XXS', 'XS', 'S', 'M',
+                                                           'L', 'XL', 'XXL', 'XXXL', 'ORIGINAL')]})
+    items.append(item)
+  return dumps({'items': items, 'limit': size, 'offset': 0}).encode()
+
+def copy_items(result):
+  # previous implementation: full items are copied into new dicts
+  res = []
+  for i in result['items']:
+    item = {key: i[key] for key in ['path', 'type', 'modified', 'sha256', 'size']}
+    item['path'] = item['path'][6:]
+    item['custom_properties'] = item.get('custom_properties')
+    res.append(item)
+  return res
+
+def bench_list():
+  for name, body, fmt in (('list full+copy', page(False), copy_items),
+                          ('list projected', page(True), lambda r: Cloud._format('list', r)),
+                          ('list records', page(True), lambda r: Cloud._format('list', r, True))):
+    start = time()
+    for _ in range(PAGES):
+      fmt(loads(body))
+    sec = (time() - start) / PAGES
+    trace_start()
+    result = fmt(loads(body))
+    kept = get_traced_memory()[0]
+    trace_stop()
+    del result
+    print('%-24s %8.1f KB/page %6.2f ms/page %8.1f KB kept' % (name, len(body) / 1024, sec * 1000,
+                                                             kept / 1024))
+
+BIG_PAGE = 100000  # number of items in the page of streamed listing
+
+class _ListHandler(BaseHTTPRequestHandler):
+  ''' answers any GET request with the big page of 'list' request'''
+  protocol_version = 'HTTP/1.1'
+  body = b''
+
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(self.body)))
+    self.end_headers()
+    self.wfile.write(self.body)
+
+  def log_message(self, *args):
+    pass
+
+def bench_items():
+  _ListHandler.body = page(True, BIG_PAGE)
+  cloud = Cloud('', {'baseurl': server(_ListHandler), 'rate_meta': 0})
+  # whole page is received and decoded before the first item is available
+  trace_start()
+  start = time()
+  status, items = cloud.task('list', BIG_PAGE, 0)
+  first = time() - start
+  for item in items:
+    pass
+  sec = time() - start
+  peak = get_traced_memory()[1]
+  trace_stop()
+  del items
+  print('%-24s %8.3f sec first %8.3f sec all %8.1f MB peak' % ('list %d items' % BIG_PAGE, first,
+                                                               sec, peak / 1048576))
+  # items are parsed and yielded as they arrive
+  trace_start()
+  start = time()
+  status, items = cloud.task('items', BIG_PAGE, 0)
+  first = None
+  for status, item in items:
+    if first is None:
+      first = time() - start
+  sec = time() - start
+  peak = get_traced_memory()[1]
+  trace_stop()
+  print('%-24s %8.3f sec first %8.3f sec all %8.1f MB peak' % ('items %d items' % BIG_PAGE, first,
+                                                               sec, peak / 1048576))
+
+FILES = 20000         # number of files in the full listing
+LIST_LATENCY = 0.1    # response time of 'list' page
+
+def bench_files():
+  fake = FakeCloud(latency=LIST_LATENCY)
+  for n in range(FILES):
+    fake.put('folder/file%06d.jpg' % n)
+  cloud = Cloud('', {'baseurl': fake.baseurl, 'rate_meta': 0})
+  for window in (1, 4, 8):
+    start = time()
+    status, items = cloud.task('files', PAGE, window)
+    n = sum(1 for status, item in items if status)
+    assert n == FILES
+    print('%-24s %8.3f sec %8.1f items/s' % ('files window %d' % window, time() - start,
+                                            n / (time() - start)))
+  fake.stop()
+
+TREE_FILES = 5000     # number of files in the tree
+TREE_LATENCY = 0.02   # response time of API request
+SHAPES = {'one folder': lambda n: 'folder/file%06d' % n,
+          '50 folders': lambda n: 'f%02d/file%06d' % (n % 50, n),
+          '1000 folders': lambda n: 'f%02d/g%02d/file%06d' % (n % 40, n // 40 % 25, n),
+          'deep': lambda n: '/'.join('d%d' % (n % 7) for _ in range(n % 12)) + '/file%06d' % n}
+
+def bench_tree():
+  for shape, name in SHAPES.items():
+    fake = FakeCloud(latency=TREE_LATENCY)
+    for n in range(TREE_FILES):
+      fake.put(name(n))
+    cloud = Cloud('', {'baseurl': fake.baseurl, 'rate_meta': 0})
+    for cmd, args in (('files', (PAGE,)), ('tree', ('/', PAGE))):
+      start = time()
+      status, items = cloud.task(cmd, *args)
+      n = sum(1 for status, item in items if status)
+      print('%-24s %8.3f sec %6d items (%d requests)' % ('%s %s' % (cmd, shape), time() - start, n,
+                                                         sum(fake.requests.values())))
+      fake.requests.clear()
+    fake.stop()
+
+if __name__ == '__main__':
+  url = server()
+  cloud = Cloud('')
+  bench_download(url, cloud)
+  bench_upload(server(_UpHandler), cloud)
+  bench_concurrency(FakeCloud(latency=LATENCY).baseurl)
+  bench_list()
+  bench_items()
+  bench_files()
+  bench_tree()
@@ -52,6 +52,10 @@ if __name__ == '__main__':
   # Setup localization
   translation(appName, '/usr/share/locale', fallback=True).install()
 
+  # global bandwidth limits of all accounts: {'up': <bytes/sec>, 'down': <bytes/sec>,
+  # 'schedule': [[<start 'HH:MM'>, <end 'HH:MM'>, <up>, <down>], ...]}
+  Disk.bandwidth(**config.get('bandwidth', {}))
+
   disks = []
   while True:
     for user in config['disks'].values():
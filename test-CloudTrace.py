@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+#  test-CloudTrace.py - offline tests of record and replay of Cloud sessions
+#
+#  Copyright 2017 Sly_tom_cat <slytomcat@mail.ru>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+import unittest
+from os import remove
+from os.path import exists, getsize
+from time import time
+from hashlib import sha256
+from Cloud import Cloud
+from FakeCloud import FakeCloud
+
+class test_CloudTrace(unittest.TestCase):
+  '''Session is recorded against FakeCloud and then replayed without it'''
+  trace = '/tmp/test-CloudTrace.jsonl.gz'
+  up = '/tmp/test-CloudTrace.up'
+  down = '/tmp/test-CloudTrace.down'
+
+  def setUp(self):
+    self.fake = FakeCloud(latency=0.05)
+    self.fake.put('dir/a', b'x' * 100000)
+    with open(self.up, 'wb') as f:
+      f.write(b'z' * 5000)
+
+  def tearDown(self):
+    self.fake.stop()
+    for f in (self.trace, self.up, self.down):
+      if exists(f):
+        remove(f)
+
+  def session(self, cloud):
+    sha = sha256(b'x' * 100000).hexdigest()   # replayed data are not checked
+    res = [cloud.task('info'), cloud.task('list', 10, 0), cloud.task('up', 'dir/b', self.up),
+           cloud.task('down', 'dir/a', self.down, sha256=sha), getsize(self.down),
+           cloud.task('res', 'not_existing_file')[0]]
+    return res
+
+  def test_CloudTrace10_record_replay(self):
+    config = {'baseurl': self.fake.baseurl, 'cache_ttl': 0}
+    cloud = Cloud('TOKEN', dict(config, trace=self.trace))
+    recorded = self.session(cloud)
+    cloud._recorder.close()
+    self.fake.stop()   # replay doesn't need the server
+    start = time()
+    cloud = Cloud('TOKEN', dict(config, replay=self.trace))
+    self.assertEqual(self.session(cloud), recorded)
+    self.assertGreater(time() - start, 0.05 * 4)   # recorded latencies are reproduced
+    self.assertEqual(cloud._player.missed, 0)
+    start = time()
+    cloud = Cloud('TOKEN', dict(config, replay=self.trace, replay_scale=0))
+    self.assertEqual(self.session(cloud), recorded)
+    self.assertLess(time() - start, 0.05 * 4)
+    self.assertFalse(cloud.task('res', 'not_recorded')[0])
+    self.assertEqual(cloud._player.missed, 1)
+
+if __name__ == '__main__':
+  unittest.main()
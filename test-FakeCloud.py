@@ -0,0 +1,616 @@
+#!/usr/bin/env python3
+#
+#  test-FakeCloud.py - offline tests of Cloud against the local stand-in server
+#
+#  Copyright 2017 Sly_tom_cat <slytomcat@mail.ru>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+import unittest
+import requests
+from os import remove, chmod, listdir, stat as file_info
+from os.path import exists, join as path_join
+from shutil import rmtree
+from tempfile import mkstemp, mkdtemp
+from time import time, mktime, sleep
+from json import dumps
+from Cloud import Cloud, _Limit, _Cache
+import AsyncCloud
+from AsyncCloud import SyncCloud
+from CloudDisk import Cloud as CloudDisk
+from FakeCloud import FakeCloud
+from PoolExecutor import ThreadPoolExecutor
+from threading import current_thread, Event
+
+class test_FakeCloud(unittest.TestCase):
+  '''Cloud commands against FakeCloud server: no token and no network are required'''
+
+  def setUp(self):
+    self.fake = FakeCloud(token='TOKEN')
+    self.cloud = Cloud('TOKEN', {'baseurl': self.fake.baseurl, 'retry_delay': 0.01,
+                                 'poll_min': 0.01, 'cache_ttl': 0})
+    self.files = []
+
+  def tearDown(self):
+    self.fake.stop()
+    for f in self.files:
+      if exists(f):
+        remove(f)
+
+  def temp(self, data=b''):
+    fd, path = mkstemp()
+    with open(fd, 'wb') as f:
+      f.write(data)
+    self.files.append(path)
+    return path
+
+  def test_FakeCloud00_info(self):
+    self.fake.put('a', b'12345')
+    stat, res = self.cloud.task('info')
+    self.assertTrue(stat)
+    self.assertEqual(res, {'total_space': self.fake.total_space, 'trash_size': 0,
+                           'used_space': 5})
+
+  def test_FakeCloud00_WrongAuth(self):
+    c = Cloud('WRONG_TOKEN', {'baseurl': self.fake.baseurl})
+    stat, res = c.task('list', 5, 0)
+    self.assertFalse(stat)
+    self.assertEqual(res[-1]['code'], 401)
+
+  def test_FakeCloud10_dirs(self):
+    self.assertEqual(self.cloud.task('mkdir', 'test dir'), (True, ('mkdir', 'test dir')))
+    self.assertEqual(self.cloud.task('mkdir', 'test dir'), (True, ('mkdir', 'test dir')))
+    stat, res = self.cloud.task('mkdir', 'not_existing_dir/bla-bla/dir')
+    self.assertFalse(stat)
+    self.assertEqual(res[-1]['code'], 409)
+    self.assertTrue(self.cloud.task('move', 'newtestdir', 'test dir')[0])
+    self.assertTrue(self.cloud.task('copy', 'test dir', 'newtestdir')[0])
+    self.assertFalse(self.cloud.task('copy', 'x', 'not_existing_dir')[0])
+    self.assertTrue(self.cloud.task('del', 'newtestdir')[0])
+    self.assertFalse(self.cloud.task('del', 'newtestdir')[0])
+    self.assertTrue(self.fake.exists('test dir'))
+
+  def test_FakeCloud20_async(self):
+    self.fake.async_time = 0.1
+    self.fake.put('d/f', b'data')
+    self.assertEqual(self.cloud.task('move', 'e', 'd'), (True, ('move', 'e', 'd')))
+    self.assertEqual(self.fake.get('e/f'), b'data')
+    self.cloud.blocking = False
+    ft = self.cloud.task('del', 'e')
+    self.assertEqual(ft.result(), (True, ('del', 'e')))
+    self.assertEqual(self.cloud.task('trash').result(), (True, ('trash',)))
+
+  def test_FakeCloud30_up_down(self):
+    data = bytes(range(256)) * 1000
+    self.assertTrue(self.cloud.task('up', 'file', self.temp(data))[0])
+    self.assertEqual(self.fake.get('file'), data)
+    stat, res = self.cloud.task('res', 'file')
+    self.assertTrue(stat)
+    self.assertEqual(res['size'], len(data))
+    self.assertEqual(self.cloud.task('last'), (True, ['file']))
+    path = self.temp()
+    self.assertTrue(self.cloud.task('down', 'file', path)[0])
+    self.assertEqual(open(path, 'rb').read(), data)
+    self.assertFalse(self.cloud.task('down', 'not_existing_file', path)[0])
+
+  def test_FakeCloud40_resume(self):
+    data = bytes(range(256)) * 1000
+    self.fake.put('file', data)
+    self.fake.fail('/download/.*', 1, 0)   # the connection is broken in the middle of data
+    path = self.temp()
+    self.assertTrue(self.cloud.task('down', 'file', path)[0])
+    self.assertEqual(open(path, 'rb').read(), data)
+    self.assertEqual(self.fake.requests['GET download'], 2)
+    cloud = Cloud('TOKEN', {'baseurl': self.fake.baseurl, 'retry_time': 0})
+    self.fake.fail('/download/.*', 1, 0)   # not resumed: network error is reported
+    stat, res = cloud.task('down', 'file', path)
+    self.assertFalse(stat)
+    self.assertNotEqual(res[-1]['error'], 'OSError')
+    self.assertNotIn('path', res[-1])
+
+  def test_FakeCloud42_segments(self):
+    data = bytes(range(256)) * 400   # 7 segments of 16 KB
+    self.fake.put('file', data)
+    config = {'baseurl': self.fake.baseurl, 'retry_delay': 0.01, 'segment_min': 1 << 10,
+              'segment_size': 16 << 10, 'segment_threads': 3}
+    cloud = Cloud('TOKEN', config)
+    path = self.temp()
+    self.assertTrue(cloud.task('down', 'file', path, size=len(data))[0])
+    self.assertEqual(open(path, 'rb').read(), data)
+    self.assertEqual(self.fake.requests['GET download'], 7)
+    self.assertEqual(cloud.metrics()['down-transfer']['count'], 7)   # each segment once
+    # the file is truncated to the continuous received part when the segment fails
+    self.fake.fail('/download/.*', 1, 0)
+    self.assertFalse(Cloud('TOKEN', dict(config, retry_time=0)).task('down', 'file', path,
+                                                                      size=len(data))[0])
+    received = file_info(path).st_size
+    self.assertLess(received, 16 << 10)
+    self.assertEqual(open(path, 'rb').read(), data[:received])
+    self.assertTrue(cloud.task('down', 'file', path, resume=True, size=len(data))[0])
+    self.assertEqual(open(path, 'rb').read(), data)
+    # the server ignores Range: the file is downloaded by single stream
+    self.fake.ranges = False
+    self.fake.requests.clear()
+    self.assertTrue(cloud.task('down', 'file', path, size=len(data))[0])
+    self.assertEqual(open(path, 'rb').read(), data)
+    self.assertEqual(self.fake.requests['GET download'], 2)
+
+  def test_FakeCloud45_stall(self):
+    cloud = Cloud('TOKEN', {'baseurl': self.fake.baseurl, 'retry_delay': 0.01, 'cache_ttl': 0,
+                            'timeout_read': 0.5, 'timeout_stall': 0.5})
+    data = bytes(range(256)) * 1000
+    self.fake.put('file', data)
+    self.fake.fail('/v1/disk', 1, -1)   # stalled request is repeated
+    start = time()
+    self.assertTrue(cloud.task('info')[0])
+    self.fake.fail('/download/.*', 1, -1)   # stalled transfer is resumed
+    path = self.temp()
+    self.assertTrue(cloud.task('down', 'file', path)[0])
+    self.assertEqual(open(path, 'rb').read(), data)
+    self.assertEqual(self.fake.requests['GET download'], 2)
+    self.assertLess(time() - start, 5)
+
+  def test_FakeCloud47_breaker(self):
+    changes = []
+    cloud = Cloud('TOKEN', {'baseurl': self.fake.baseurl, 'retry_delay': 0.01, 'cache_ttl': 0,
+                            'breaker_errors': 3, 'breaker_delay': 0.1})
+    cloud.network = changes.append
+    self.fake.put('file', b'data')
+    path = self.temp()
+    executor = ThreadPoolExecutor(4)
+    try:
+      self.fake.offline = True
+      fts = [executor.submit(cloud.task, cmd, *args) for cmd, args in
+             (('info', ()), ('res', ('file',)), ('mkdir', ('dir',)), ('down', ('file', path)))]
+      start = time()
+      while not changes and time() - start < 5:
+        sleep(0.05)
+      self.assertEqual(changes, [False])
+      sleep(0.3)
+      self.assertFalse(any(ft.done() for ft in fts))   # requests are parked, not failed
+      self.fake.offline = False   # the network is back: parked requests continue
+      self.assertTrue(all(ft.result(5)[0] for ft in fts))
+      self.assertEqual(changes, [False, True])
+      self.assertTrue(self.fake.exists('dir'))
+      self.assertEqual(open(path, 'rb').read(), b'data')
+      self.fake.offline = True
+      ft = executor.submit(cloud.task, 'info')
+      while len(changes) < 3 and time() - start < 10:
+        sleep(0.05)
+      cloud.release()   # parked requests fail at once
+      self.assertFalse(ft.result(5)[0])
+    finally:
+      self.fake.offline = False
+      executor.shutdown()
+
+  def test_FakeCloud48_breaker_stall(self):
+    changes = []
+    cloud = Cloud('TOKEN', {'baseurl': self.fake.baseurl, 'retry_delay': 0.01,
+                            'timeout_stall': 0.3, 'breaker_errors': 1, 'breaker_delay': 0.1})
+    cloud.network = changes.append
+    data = bytes(range(256)) * 1000
+    self.fake.put('file', data)
+    self.fake.fail('/download/.*', 2, -1)   # stalled transfers don't mean the network is lost
+    path = self.temp()
+    self.assertTrue(cloud.task('down', 'file', path)[0])
+    self.assertEqual(open(path, 'rb').read(), data)
+    self.assertEqual(changes, [])
+
+  def test_FakeCloud50_errors(self):
+    self.fake.fail('/v1/disk', 2, 503)
+    self.assertTrue(self.cloud.task('info')[0])
+    self.assertEqual(self.fake.requests['GET /v1/disk'], 3)
+    self.fake.fail('/v1/disk/resources/move', 1, 500)
+    self.fake.put('a')
+    stat, res = self.cloud.task('move', 'b', 'a')   # not idempotent operation is not retried
+    self.assertFalse(stat)
+    self.assertEqual(res[-1]['code'], 500)
+    self.fake.rate = 5
+    self.assertTrue(all(self.cloud.task('res', 'a')[0] for _ in range(10)))
+
+  def test_FakeCloud55_cache(self):
+    calls = []
+    gate = Event()
+    gate.set()
+
+    def func():
+      gate.wait(5)
+      calls.append(None)
+      return True, {'n': len(calls)}
+
+    executor = ThreadPoolExecutor(2)
+    cache = _Cache(0.2, executor)
+    try:
+      res = cache.get('k', func)
+      res[1]['n'] = 0   # callers receive copies
+      self.assertEqual(cache.get('k', func), (True, {'n': 1}))
+      self.assertEqual(len(calls), 1)
+      sleep(0.25)   # expired result is returned and it is refreshed once in background
+      gate.clear()
+      self.assertEqual([cache.get('k', func) for i in range(3)], [(True, {'n': 1})] * 3)
+      gate.set()
+      sleep(0.1)
+      self.assertEqual(cache.get('k', func), (True, {'n': 2}))
+      sleep(0.25)   # refresh started before invalidation doesn't store its result
+      gate.clear()
+      self.assertEqual(cache.get('k', func), (True, {'n': 2}))
+      cache.invalidate()
+      gate.set()
+      sleep(0.1)
+      self.assertEqual(len(calls), 3)
+      self.assertEqual(cache.get('k', func), (True, {'n': 4}))
+    finally:
+      gate.set()
+      executor.shutdown()
+    # changes of disk content invalidate the cached results
+    cloud = Cloud('TOKEN', {'baseurl': self.fake.baseurl, 'cache_ttl': 60})
+    last = lambda: self.fake.requests.get('GET /v1/disk/resources/last-uploaded', 0)
+    for cmd, args in (('up', ('a', self.temp(b'data'))), ('copy', ('b', 'a')), ('move', ('c', 'b')),
+                      ('del', ('c',))):
+      self.assertTrue(cloud.task('last')[0])
+      n = last()
+      self.assertTrue(cloud.task('last')[0])
+      self.assertEqual(last(), n)
+      self.assertTrue(cloud.task(cmd, *args)[0])
+      self.assertTrue(cloud.task('last')[0])
+      self.assertEqual(last(), n + 1)
+
+  def test_FakeCloud57_metrics(self):
+    data = bytes(range(256)) * 100
+    self.fake.fail('/v1/disk', 1, 503)   # the retried request is registered once
+    self.assertTrue(self.cloud.task('info')[0])
+    self.assertFalse(self.cloud.task('res', 'not_existing_file')[0])
+    self.assertTrue(self.cloud.task('up', 'file', self.temp(data))[0])
+    self.assertTrue(self.cloud.task('down', 'file', self.temp())[0])
+    m = self.cloud.metrics()
+    self.assertEqual(m['retries'], 1)
+    self.assertEqual({name: (m[name]['count'], m[name]['errors'], m[name]['status'])
+                      for name in ('info', 'res', 'up-href', 'up-transfer', 'down-href',
+                                   'down-transfer')},
+                     {'info': (1, 0, {200: 1}), 'res': (1, 1, {404: 1}),
+                      'up-href': (1, 0, {200: 1}), 'up-transfer': (1, 0, {201: 1}),
+                      'down-href': (1, 0, {200: 1}), 'down-transfer': (1, 0, {200: 1})})
+    self.assertEqual(m['up-transfer']['bytes'], len(data))
+    self.assertEqual(m['down-transfer']['bytes'], len(data))
+    self.assertGreater(m['info']['bytes'], 0)
+    self.assertEqual(sum(m['res']['hist']), 1)
+    self.assertIn('poll', m)
+
+  def test_FakeCloud60_list(self):
+    for i in range(25):
+      self.fake.put('dir/file%02d' % i, b'x' * i)
+    stat, res = self.cloud.task('list', 10, 20)
+    self.assertTrue(stat)
+    self.assertEqual([i['path'] for i in res], ['dir/file%02d' % i for i in range(20, 25)])
+    self.assertFalse(self.cloud.task('list', 7777777777, 0)[0])
+    stat, res = self.cloud.task('items', 100, 0)
+    self.assertTrue(stat)
+    self.assertEqual(len([i for s, i in res if s]), 25)
+    stat, res = self.cloud.task('files', 7, 3)
+    self.assertEqual([i['path'] for s, i in res], ['dir/file%02d' % i for i in range(25)])
+    # 3 requests above, 4 pages and not more than 2 pages requested after the last one
+    self.assertLessEqual(self.fake.requests['GET /v1/disk/resources/files'], 3 + 4 + 2)
+    stat, res = self.cloud.task('res_many', ['dir/file01', 'dir/file02', 'nothing'])
+    self.assertEqual([res[p][0] for p in ('dir/file01', 'dir/file02', 'nothing')],
+                     [True, True, False])
+
+  def test_FakeCloud61_files_stream(self):
+    for i in range(1500):
+      self.fake.put('dir/file%04d' % i)
+    self.fake.bandwidth = 100 << 10   # the page of 1000 items (about 170 KB) takes 1.7 sec
+    start = time()
+    stat, res = self.cloud.task('files', 1000, 2)
+    self.assertTrue(next(res)[0])
+    first = time() - start
+    self.assertEqual(len([i for s, i in res if s]), 1499)
+    # the first item is yielded before its page is received completely
+    self.assertLess(first, (time() - start) / 2)
+
+  def test_FakeCloud62_items_resume(self):
+    class Broken(object):
+      ''' response that is broken after two items'''
+      closed = False
+      def iter_content(self, size):
+        yield dumps({'items': [{'path': 'disk:/a'}, {'path': 'disk:/b'}]})[:-2].encode() + b','
+        raise requests.exceptions.ChunkedEncodingError('broken')
+      def close(self):
+        self.closed = True
+    r = Broken()
+    self.fake.fail('/v1/disk/resources/files', 1, 400)   # the request of the rest fails
+    res = list(self.cloud._items(r, 5, 0))
+    self.assertEqual([(s, i['path']) for s, i in res[:2]], [(True, 'a'), (True, 'b')])
+    self.assertFalse(res[2][0])
+    self.assertEqual(res[2][1][-1]['code'], 400)
+    self.assertEqual(len(res), 3)
+    self.assertTrue(r.closed)
+
+  def test_FakeCloud63_prefetch(self):
+    links = lambda kind: self.fake.requests.get('GET /v1/disk/resources/' + kind, 0)
+    data = self.temp(b'data')
+    cloud = Cloud('TOKEN', {'baseurl': self.fake.baseurl, 'retry_delay': 0.01, 'prefetch': 2})
+    for i in range(4):
+      cloud.prefetch('up', 'f%d' % i)
+    sleep(0.3)
+    self.assertEqual(links('upload'), 2)   # not more than 'prefetch' links at once
+    self.assertTrue(cloud.task('up', 'f0', data)[0])
+    sleep(0.3)
+    self.assertEqual(links('upload'), 3)   # prefetched link is used, the next one is requested
+    cloud = Cloud('TOKEN', {'baseurl': self.fake.baseurl, 'retry_delay': 0.01, 'href_ttl': 0.1})
+    cloud.prefetch('up', 'f9')
+    sleep(0.3)
+    self.assertTrue(cloud.task('up', 'f9', data)[0])
+    self.assertEqual(links('upload'), 5)   # expired link is not used
+    self.fake.href_ttl = 0.1
+    cloud = Cloud('TOKEN', {'baseurl': self.fake.baseurl, 'retry_delay': 0.01})
+    cloud.prefetch('down', 'f9')
+    sleep(0.3)
+    path = self.temp()
+    self.assertTrue(cloud.task('down', 'f9', path)[0])   # 410 Gone: repeated with the new link
+    self.assertEqual(links('download'), 2)
+    self.assertEqual(self.fake.requests['GET download'], 2)
+    self.assertEqual(open(path, 'rb').read(), b'data')
+
+  def test_FakeCloud65_tree(self):
+    for i in range(5):
+      self.fake.put('dir/file%d' % i)
+    self.fake.put('dir/sub dir/file')
+    self.assertTrue(self.cloud.task('mkdir', 'empty')[0])
+    stat, res = self.cloud.task('tree', '/', 2)   # folders are listed by pages of 2 items
+    self.assertTrue(stat)
+    self.assertEqual([(i['path'], i['type']) for s, i in res],
+                     [('dir', 'dir'), ('empty', 'dir'), ('dir/file0', 'file'), ('dir/file1', 'file'),
+                      ('dir/file2', 'file'), ('dir/file3', 'file'), ('dir/file4', 'file'),
+                      ('dir/sub dir', 'dir'), ('dir/sub dir/file', 'file')])
+    stat, res = self.cloud.task('tree', 'not_existing_dir')
+    self.assertEqual([s for s, i in res], [False])
+    res = list(self.cloud.task('tree', 'dir/file0')[1])   # the path is a file
+    self.assertEqual([s for s, i in res], [False])
+    self.assertEqual(res[0][1][-1]['error'], 'NotADirectoryError')
+
+  def test_FakeCloud70_prop(self):
+    self.fake.put('a')
+    self.assertTrue(self.cloud.task('prop', 'a', mode=33188)[0])
+    stat, res = self.cloud.task('res', 'a')
+    self.assertEqual(res['custom_properties'], {'mode': 33188})
+
+  def test_FakeCloud75_sha256(self):
+    data = bytes(range(256)) * 1000
+    self.fake.put('file', data)
+    sha = self.cloud.task('res', 'file')[1]['sha256']
+    path = self.temp()
+    self.assertTrue(self.cloud.task('down', 'file', path, sha256=sha)[0])
+    self.assertEqual(open(path, 'rb').read(), data)
+    with open(path, 'wb') as f:
+      f.write(data[:1000])   # resumed download: received part is hashed from the file
+    self.fake.fail('/download/.*', 1, 0)
+    self.assertTrue(self.cloud.task('down', 'file', path, resume=True, sha256=sha)[0])
+    self.assertEqual(open(path, 'rb').read(), data)
+    stat, res = self.cloud.task('down', 'file', path, sha256='0' * 64)
+    self.assertFalse(stat)
+    self.assertEqual(res[-1]['error'], 'ChecksumMismatchError')
+    self.assertEqual(open(path, 'rb').read(), b'')
+
+  def test_FakeCloud80_bandwidth(self):
+    at = lambda h, m: mktime((2017, 3, 1, h, m, 0, 0, 0, -1))
+    limit = _Limit(100, [('23:00', '07:00', 0), ('12:00', '13:00', 50)])
+    self.assertEqual([limit.rate(at(h, m)) for h, m in ((23, 0), (3, 30), (7, 0), (12, 59), (13, 0))],
+                     [0, 0, 100, 50, 100])
+    rate = 256 << 10
+    data = bytes(2 * rate)   # the first half passes at once (burst), the second takes 1 sec
+    cloud = Cloud('TOKEN', {'baseurl': self.fake.baseurl, 'bw_up': rate, 'bw_down': rate})
+    start = time()
+    self.assertTrue(cloud.task('up', 'file', self.temp(data))[0])
+    self.assertGreater(time() - start, 0.9)
+    path = self.temp()
+    start = time()
+    self.assertTrue(cloud.task('down', 'file', path)[0])
+    self.assertGreater(time() - start, 0.9)
+    self.assertEqual(open(path, 'rb').read(), data)
+    Cloud.bandwidth(down=rate)   # global limit is applied to all accounts
+    try:
+      start = time()
+      self.assertTrue(self.cloud.task('down', 'file', path)[0])
+      self.assertGreater(time() - start, 0.9)
+    finally:
+      Cloud.bandwidth()
+
+class test_FakeCloudDisk(unittest.TestCase):
+  '''application level logic of CloudDisk against FakeCloud server'''
+
+  def setUp(self):
+    self.fake = FakeCloud(token='TOKEN')
+    self.path = mkdtemp()
+    self.disk = CloudDisk('TOKEN', self.path, path_join(self.path, '.work'),
+                          {'baseurl': self.fake.baseurl, 'retry_delay': 0.01, 'cache_ttl': 0,
+                           'dedup_min': 1})
+
+  def tearDown(self):
+    self.fake.stop()
+    rmtree(self.path)
+
+  def local(self, name, data, mode=0o644):
+    path = path_join(self.path, name)
+    with open(path, 'wb') as f:
+      f.write(data)
+    chmod(path, mode)
+    return path
+
+  def test_CloudDisk10_skip(self):
+    for i in range(4):
+      self.fake.put('f%d' % i, b'data%d' % i)
+      self.local('f%d' % i, b'data%d' % i, 0o600 if i == 3 else 0o644)
+    for i in range(3):   # the cloud files keep the modes of local files except the last one
+      self.assertTrue(self.disk._r_setMode(path_join(self.path, 'f%d' % i),
+                                           file_info(path_join(self.path, 'f%d' % i)).st_mode)[0])
+    self.fake.requests.clear()
+    self.assertEqual(len([i for s, i in self.disk.task('list')]), 4)
+    for i in range(4):
+      self.assertTrue(self.disk.task('up', path_join(self.path, 'f%d' % i))[0])
+    # nothing is uploaded and only the mode of the last file is stored
+    self.assertNotIn('GET /v1/disk/resources/upload', self.fake.requests)
+    self.assertNotIn('PUT upload', self.fake.requests)
+    self.assertEqual(self.fake.requests.get('PATCH /v1/disk/resources'), 1)
+
+  def test_CloudDisk15_deleted(self):
+    for name in ('a', 'b'):
+      self.fake.put(name, b'data ' + name.encode())
+      self.local(name, b'data ' + name.encode())
+    self.assertEqual(len([i for s, i in self.disk.task('list')]), 2)
+    self.fake._remove('/a')   # other client deletes the file: it is not listed anymore
+    self.assertEqual(len([i for s, i in self.disk.task('list')]), 1)
+    self.assertEqual(self.disk.task('up', path_join(self.path, 'a')), (True, ('up', 'a')))
+    self.assertEqual(self.fake.get('a'), b'data a')
+    self.fake._remove('/b')   # deleted after the listing: it is found by storing of the mode
+    chmod(path_join(self.path, 'b'), 0o600)
+    self.assertEqual(self.disk.task('up', path_join(self.path, 'b')), (True, ('up', 'b')))
+    self.assertEqual(self.fake.get('b'), b'data b')
+
+  def test_CloudDisk20_dedup(self):
+    self.fake.put('src', b'content')
+    self.fake.put('dst', b'old content')
+    self.local('dst', b'content')   # modified file has the content of other cloud file
+    self.local('new', b'content')
+    self.assertEqual(len([i for s, i in self.disk.task('list')]), 2)
+    self.fake.requests.clear()
+    for name in ('dst', 'new'):
+      self.assertEqual(self.disk.task('up', path_join(self.path, name)), (True, ('up', name)))
+      self.assertEqual(self.fake.get(name), b'content')
+    self.assertEqual(self.fake.requests['POST /v1/disk/resources/copy'], 2)
+    self.assertNotIn('PUT upload', self.fake.requests)
+    self.assertEqual(self.disk.c_data[path_join(self.path, 'dst')],
+                     self.disk._hash(path_join(self.path, 'dst')))
+
+  def test_CloudDisk30_prefetch(self):
+    for i in range(5):
+      self.fake.put('f%d' % i, b'data%d' % i)
+      self.local('f%d' % i, b'data%d' % i)
+      self.disk._hash(path_join(self.path, 'f%d' % i))   # files are hashed by sync
+    self.local('copy', b'data0')
+    self.disk._hash(path_join(self.path, 'copy'))
+    self.local('new', b'new data')
+    self.assertEqual(len([i for s, i in self.disk.task('list')]), 5)
+    for name in ['f%d' % i for i in range(5)] + ['copy', 'new']:
+      self.disk.prefetch('up', path_join(self.path, name))
+    sleep(0.3)
+    # the links are not requested for skipped and copied uploads
+    self.assertEqual(self.fake.requests['GET /v1/disk/resources/upload'], 1)
+
+  def test_CloudDisk40_partial(self):
+    for name in ('a', 'b', 'c'):
+      self.fake.put(name, b'data')
+    self.disk = CloudDisk('TOKEN', self.path, path_join(self.path, '.work'),
+                          {'baseurl': self.fake.baseurl, 'retry_time': 0})
+    self.fake.fail('/download/.*', 3, 0)   # downloads are broken: partial files are kept
+    for name in ('a', 'b', 'c'):
+      self.assertFalse(self.disk.task('down', path_join(self.path, name))[0])
+    partial = lambda: sorted(listdir(path_join(self.path, '.work', 'partial')))
+    self.assertEqual(len(partial()), 6)
+    self.assertTrue(self.disk.task('del', path_join(self.path, 'a'))[0])
+    self.assertFalse(self.disk.task('down', path_join(self.path, 'a'))[0])
+    self.assertEqual(len(partial()), 4)   # removed as the cloud file is not found
+    self.fake.put('d', b'data')   # other client deletes the file and adds new one
+    self.fake._remove('/b')
+    self.assertEqual(len([i for s, i in self.disk.task('list')]), 2)
+    self.assertEqual(partial(), [self.disk._partial('c')[-40:], self.disk._partial('c')[-40:] +
+                                 '.info'])
+
+  def test_CloudDisk45_sweep(self):
+    self.fake.put('a', b'data')
+    self.disk = CloudDisk('TOKEN', self.path, path_join(self.path, '.work'),
+                          {'baseurl': self.fake.baseurl, 'retry_delay': 0.01, 'timeout_read': 0.5})
+    self.fake.fail('/v1/disk/resources/download', 1, -1)   # the link request is in flight
+    executor = ThreadPoolExecutor(1)
+    try:
+      ft = executor.submit(self.disk.task, 'down', path_join(self.path, 'a'))
+      sleep(0.2)
+      self.disk._sweep(set())   # the listing ends while the download is in progress
+      self.assertEqual(len(listdir(path_join(self.path, '.work', 'partial'))), 1)
+      self.assertTrue(ft.result(5)[0])
+    finally:
+      executor.shutdown()
+    self.assertEqual(open(path_join(self.path, 'a'), 'rb').read(), b'data')
+    self.assertEqual(listdir(path_join(self.path, '.work', 'partial')), [])
+
+class test_FakeSyncCloud(unittest.TestCase):
+  '''AsyncCloud via SyncCloud adapter against FakeCloud server'''
+
+  def setUp(self):
+    self.fake = FakeCloud(token='TOKEN')
+    self.cloud = SyncCloud('TOKEN', {'baseurl': self.fake.baseurl, 'retry_delay': 0.01,
+                                     'poll_min': 0.01})
+    fd, self.path = mkstemp()
+    open(fd).close()
+
+  def tearDown(self):
+    self.cloud.close()
+    self.fake.stop()
+    remove(self.path)
+
+  def test_SyncCloud10_commands(self):
+    self.fake.put('d/f', b'data')
+    self.assertTrue(self.cloud.task('info')[0])
+    self.assertEqual(self.cloud.task('res', 'd/f')[1]['size'], 4)
+    self.assertEqual(self.cloud.task('copy', 'd/g', 'd/f'), (True, ('copy', 'd/g', 'd/f')))
+    self.fake.put('d/h', b'new')
+    self.assertFalse(self.cloud.task('copy', 'd/g', 'd/h')[0])
+    self.assertTrue(self.cloud.task('copy', 'd/g', 'd/h', overwrite=True)[0])
+    self.assertEqual(self.fake.get('d/g'), b'new')
+    for cmd in ('items', 'files', 'tree'):
+      stat, res = self.cloud.task(cmd, 100)
+      self.assertFalse(stat)
+      self.assertEqual(res[-1]['error'], 'NotSupportedError')
+
+  def test_SyncCloud20_down(self):
+    data = bytes(range(256)) * 1000
+    self.fake.put('file', data)
+    sha = self.cloud.task('res', 'file')[1]['sha256']
+    with open(self.path, 'wb') as f:
+      f.write(data[:1000])
+    self.fake.fail('/download/.*', 1, 0)   # broken transfer is resumed
+    self.assertTrue(self.cloud.task('down', 'file', self.path, resume=True, size=len(data),
+                                    sha256=sha)[0])
+    self.assertEqual(open(self.path, 'rb').read(), data)
+    self.assertEqual(self.fake.requests['GET download'], 2)
+    stat, res = self.cloud.task('down', 'file', self.path, sha256='0' * 64)
+    self.assertFalse(stat)
+    self.assertEqual(res[-1]['error'], 'ChecksumMismatchError')
+    self.assertEqual(open(self.path, 'rb').read(), b'')
+
+  def test_SyncCloud30_executor(self):
+    threads = []
+
+    class Digest(AsyncCloud._Digest):
+      def seek(self, pos):
+        threads.append(current_thread().name)
+        super().seek(pos)
+
+    data = bytes(range(256)) * 1000
+    self.fake.put('file', data)
+    sha = self.cloud.task('res', 'file')[1]['sha256']
+    with open(self.path, 'wb') as f:
+      f.write(data[:1000])
+    original, AsyncCloud._Digest = AsyncCloud._Digest, Digest
+    try:
+      self.assertTrue(self.cloud.task('down', 'file', self.path, resume=True, sha256=sha)[0])
+    finally:
+      AsyncCloud._Digest = original
+    # the received part of file is hashed out of the event loop thread
+    self.assertEqual(len(threads), 2)
+    self.assertNotIn('AsyncCloud', threads)
+
+if __name__ == '__main__':
+  unittest.main()